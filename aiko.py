@@ -7,21 +7,53 @@ aiko gives read/write functionality for a .hdf5 database.
 it can also generate graphics
 """
 
-import h5py
 import numpy as np
 import sys
 import os
-import pandas as pd
 import re
-import scipy.interpolate
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
 import glob
+import concurrent.futures
+import multiprocessing.shared_memory
+import copy
+import hashlib
+import json
+import shutil
+import contextlib
+import logging
+import time
+import operator
+import importlib
+
+
+#module that is imported on first attribute access, submodules (scipy.spatial, ...) are imported as they are used
+class lazy_module():
+    def __init__(self, name):
+        self.__dict__["name"] = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.name)
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            return importlib.import_module(self.name + "." + attr)
+
+
+#heavy dependencies load when first used: reading loads pandas and h5py, map/orbit matplotlib and scipy.interpolate,
+#so short jobs and the command line do not pay for plotting
+h5py = lazy_module("h5py")
+pd = lazy_module("pandas")
+scipy = lazy_module("scipy")
+matplotlib = lazy_module("matplotlib")
+plt = lazy_module("matplotlib.pyplot")
+colors = lazy_module("matplotlib.colors")
+
+
+logger = logging.getLogger("aiko")
 
 class arepo_reader():
     #defines vars
-    def __init__(self, path, snapshotRange, particleTypes=["Gas", "DM", "Stars"], blockNames=["Coordinates", "Velocities", "Density"], groupBlockNames=["Velocities", "CenterOfMass", "Radius", "Coordinates", "Mass"]):
-        if path[-1] is not "/":
+    def __init__(self, path, snapshotRange, particleTypes=["Gas", "DM", "Stars"], blockNames=["Coordinates", "Velocities", "Density"], groupBlockNames=["Velocities", "CenterOfMass", "Radius", "Coordinates", "Mass"], workers=None, cacheDir=None, cacheSize=10*1024**3, region=None, fileFormat="hdf5", stats=None, catalogue=None):
+        if path[-1] != "/":
             path = path + "/"
         if len(snapshotRange) == 1:
             snapshotRange = [snapshotRange[0], snapshotRange[0], 1]
@@ -35,6 +67,27 @@ class arepo_reader():
         self.particleTypes = particleTypes
         self.blockNames = blockNames
         self.groupBlockNames = groupBlockNames
+        self.workers = workers
+        self.boxSize = None
+        self.cache = None
+        if cacheDir is not None:
+            self.cache = snapshot_cache(cacheDir, cacheSize)
+        self.region = region
+        self.fileBounds = {}
+        self.fileFormat = fileFormat
+        self.haloReaders = {}
+        self.memberships = {}
+        #read_stats collecting per-stage timings and I/O of every read, True makes a new one
+        if stats == True:
+            stats = read_stats()
+        self.stats = stats
+        #snapshot_catalogue the snapshot and group readers plan from, True keeps its sidecar in cacheDir (or next to the data)
+        if catalogue == True:
+            sidecarDir = self.cache.cacheDir if self.cache is not None else path
+            catalogue = sidecarDir + "aiko_catalogue.json"
+        self.catalogue = None
+        if catalogue is not None:
+            self.catalogue = snapshot_catalogue(path, catalogue)
 
     #gets list of dirnames for each selected snapshot
     def get_path_raw(self, snapshot):
@@ -48,63 +101,893 @@ class arepo_reader():
         path = self.path + groupdir
         return path
 
+    #returns the snapshot reader of one snapdir for the fileFormat ("hdf5" or "gadget" for hdf5_gadget.py output)
+    def get_raw_instance(self, currentPath):
+        entry = self.get_catalogue_entry(currentPath)
+        if self.fileFormat == "gadget":
+            return snapshot_read_gadget(currentPath, particleTypes=self.particleTypes, blockNames=self.blockNames, catalogue=entry)
+        return snapshot_read_raw(currentPath, particleTypes=self.particleTypes, blockNames=self.blockNames, catalogue=entry)
+
+    #returns the group catalogue reader of one groups dir
+    def get_gal_instance(self, currentPath):
+        return snapshot_read_gal(currentPath, blockNames=self.groupBlockNames, catalogue=self.get_catalogue_entry(currentPath))
+
+    #returns the catalogue entry of a snapdir/groups dir, None without catalogue (the readers then list the dir themselves)
+    def get_catalogue_entry(self, currentPath):
+        if self.catalogue is None:
+            return None
+        return self.catalogue.get_entry(os.path.basename(currentPath.rstrip("/")))
+
+    #rescans the snapdir/groups directories of the reader's snapshots that changed since the last read
+    #files are stat'ed too (verify), a chunk file rewritten in place keeps the directory mtime but must not keep its
+    #old stamp and counts, which cache keys, region bounds and the preallocated table rely on
+    def update_catalogue(self, verify=True):
+        if self.catalogue is not None:
+            names = [kind + "_%03d" % snapshot for snapshot in sorted(set(int(s) for s in self.snapshots)) for kind in ["snapdir", "groups"]]
+            with self.stage("catalogue") as record:
+                record["files"] = sum(len(self.catalogue.get_entry(name)["files"]) for name in self.catalogue.update(verify, names))
+
+    #scans every snapdir/groups directory of the simulation into the catalogue, returns the names of the scanned ones
+    def build_catalogue(self, verify=False):
+        if self.catalogue is None:
+            raise ValueError("reader has no catalogue, pass catalogue= to arepo_reader")
+        return self.catalogue.update(verify)
+
+    #returns a timing context of read_stats for stage of snapshot/filename, a no-op one without stats
+    #the yielded record takes "rows" and "files" of the stage
+    def stage(self, name, snapshot=None, filename=None):
+        if self.stats is None:
+            return contextlib.nullcontext({})
+        return self.stats.stage(name, snapshot, filename)
+
     # returns galaxy data in df (main function)
     def read_arepo_gal(self):
-        dataList = []
-        print("reading...")
+        logger.info("reading...")
+        self.update_catalogue()
+        instances = []
         for snapshot in self.snapshots:
             currentPath = self.get_path_gal(snapshot)
-            currentInstance = snapshot_read_gal(currentPath, blockNames=self.groupBlockNames)
-            currentData = currentInstance.read_arepo_gal()
-            dataList.append(currentData)
-        print("processing...")
-        dfAll = pd.concat(dataList, ignore_index=True)
+            with self.stage("open", int(snapshot)):
+                instances.append(self.get_gal_instance(currentPath))
+        with self.stage("read") as record:
+            if self.cache is not None:
+                dataList = self.read_cached_gal(instances)
+            else:
+                dataList = self.read_files(instances, [i.get_groupdirList() for i in instances])
+            record["rows"] = sum(len(df) for df in dataList)
+        logger.info("processing...")
+        with self.stage("concat") as record:
+            dfAll = pd.concat(dataList, ignore_index=True)
+            record["rows"] = len(dfAll)
         #dfAll.set_index("ID", inplace=True)
-        print("done!")
+        logger.info("done!")
         return dfAll
 
-    # returns full list in df (main function)
-    def read_arepo_raw(self):
-        dataList = []
-        print("reading...")
+    # returns full list in df (main function), index=True attaches a spatial_index for norm_select/map
+    def read_arepo_raw(self, index=False):
+        logger.info("reading...")
+        self.update_catalogue()
+        instances = []
         for snapshot in self.snapshots:
             currentPath = self.get_path_raw(snapshot)
-            currentInstance = snapshot_read_raw(currentPath, particleTypes=self.particleTypes, blockNames=self.blockNames)
-            currentData = currentInstance.read_arepo_snap()
-            dataList.append(currentData)
-        print("processing...")
-        dfAll = pd.concat(dataList, ignore_index=True)
-        dfAll.set_index("ID", inplace=True)
-        print("done!")
+            with self.stage("open", int(snapshot)):
+                instances.append(self.get_raw_instance(currentPath))
+        self.boxSize = instances[-1].boxSize
+        with self.stage("read") as record:
+            if self.region is not None:
+                dataList = self.read_region_raw(instances)
+            elif self.cache is not None:
+                dataList = self.read_cached_raw(instances)
+            else:
+                dataList = None
+                dfAll = self.read_direct_raw(instances)
+            record["rows"] = len(dfAll) if dataList is None else sum(len(df) for df in dataList)
+        logger.info("processing...")
+        if dataList is not None:
+            with self.stage("concat") as record:
+                table = particle_table(sum(len(df) for df in dataList), instances[0].get_float_columns())
+                offset = 0
+                for df in dataList:
+                    table.put_frame(offset, df)
+                    offset += len(df)
+                dfAll = table.to_frame()
+                record["rows"] = len(dfAll)
+        if index == True:
+            logger.info("indexing...")
+            with self.stage("index") as record:
+                build_spatial_index(dfAll, self.boxSize)
+                record["rows"] = len(dfAll)
+        logger.info("done!")
         return dfAll
 
+    #reads all snapshots straight into one preallocated particle_table sized from the file headers
+    #with workers every file is read by a worker into its rows of a shared memory table, nothing is pickled back
+    def read_direct_raw(self, instances):
+        taskInstances = []
+        taskFiles = []
+        taskOffsets = []
+        numRows = 0
+        with self.stage("count") as record:
+            for instance in instances:
+                for filename in instance.get_snapdirList():
+                    taskInstances.append(instance)
+                    taskFiles.append(filename)
+                    taskOffsets.append(numRows)
+                    numRows += sum(instance.get_file_counts(filename).values())
+            record["rows"] = numRows
+            record["files"] = len(taskFiles)
+        taskEnds = taskOffsets[1:] + [numRows]
+        parallel = self.workers is not None and self.workers > 1 and len(taskFiles) > 1
+        table = particle_table(numRows, instances[0].get_float_columns(), shared=parallel)
+        try:
+            if parallel:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+                    results = list(pool.map(read_file_into, taskInstances, taskFiles, [table.get_spec()]*len(taskFiles), taskOffsets))
+            else:
+                results = [read_file_into(instance, filename, table, offset) for instance, filename, offset in zip(taskInstances, taskFiles, taskOffsets)]
+            for (end, record), expected, filename in zip(results, taskEnds, taskFiles):
+                if self.stats is not None:
+                    self.stats.add(record)
+                if end != expected:
+                    raise ValueError("{} holds other particle counts than its counted header, files changed while reading".format(filename))
+            return table.to_frame()
+        finally:
+            table.close(unlink=True)
+
+    #returns the read_arepo_raw df as a lazy dask DataFrame, one partition per chunk file of every snapshot (needs dask)
+    #only the blocks of the columns dask asks for are read. filters is a list of (column, op, value), op one of
+    #==, !=, <, <=, >, >=, in, applied to every partition as it is read; Snap and Type filters also drop whole
+    #snapshots and particle types before reading, and with a region set files are skipped and rows cut as in read_region_raw
+    def read_arepo_lazy(self, filters=None):
+        try:
+            import dask.dataframe as dd
+        except ImportError:
+            raise ImportError("read_arepo_lazy needs dask, install it with pip install 'dask[dataframe]'")
+        filters = list(filters or [])
+        self.update_catalogue()
+        instances = []
+        for snapshot in self.snapshots:
+            if apply_filters(pd.DataFrame({"Snap":[snapshot]}), [f for f in filters if f[0] == "Snap"]).empty:
+                continue
+            instance = self.get_raw_instance(self.get_path_raw(snapshot))
+            types = pd.DataFrame({"Type":instance.particleTypeIndexes})
+            instance.particleTypeIndexes = list(apply_filters(types, [f for f in filters if f[0] == "Type"])["Type"])
+            instances.append(instance)
+        if not instances:
+            raise ValueError("filters {} select no snapshot of {}".format(filters, list(self.snapshots)))
+        self.boxSize = instances[-1].boxSize
+        if self.region is not None:
+            queryRegion = copy.copy(self.region)
+            if queryRegion.boxSize is None:
+                queryRegion.boxSize = self.boxSize
+        #files whose known bounds miss the region or the position filters are no partitions
+        positionFilters = [f for f in filters if f[0] in ("posX", "posY", "posZ")]
+        partInstances = []
+        partFiles = []
+        for instance in instances:
+            if self.region is not None:
+                instance.region = queryRegion
+            for filename in instance.get_snapdirList():
+                if self.region is not None or positionFilters:
+                    entry = self.load_bounds(filename)
+                    if entry is not None:
+                        instance.fileBounds[filename] = entry
+                        if self.region is not None and instance.region_misses(filename):
+                            continue
+                        if positionFilters and instance.filters_miss(filename, positionFilters):
+                            continue
+                if self.catalogue is not None and sum(instance.get_file_counts(filename).values()) == 0:
+                    continue
+                partInstances.append(instance)
+                partFiles.append(filename)
+        if not partFiles:
+            partInstances, partFiles = instances[:1], [None]
+        meta = particle_table(0, instances[0].get_float_columns()).to_frame()
+        return dd.from_map(read_lazy_partition, partInstances, partFiles, filters=filters, meta=meta, label="read-arepo")
+
+    #returns the particles of group (or subhalo) number of one snapshot, numbered as in that snapshot's catalogue
+    #the group offsets select contiguous rows per type, so only the files holding the halo are read
+    def read_halo(self, snapshot, number, subhalo=False):
+        key = (int(snapshot), subhalo)
+        if key not in self.haloReaders:
+            self.update_catalogue()
+            galInstance = self.get_gal_instance(self.get_path_gal(snapshot))
+            instance = self.get_raw_instance(self.get_path_raw(snapshot))
+            if instance.repacked:
+                raise ValueError("snapshot {} is repacked, the group offsets do not apply to its particle order".format(snapshot))
+            lenType, offsetType = galInstance.read_offsets(subhalo=subhalo)
+            self.haloReaders[key] = (instance, lenType, offsetType)
+        instance, lenType, offsetType = self.haloReaders[key]
+        typeRows = {}
+        for particleTypeIndex in instance.particleTypeIndexes:
+            start = offsetType[number, particleTypeIndex]
+            typeRows[particleTypeIndex] = (start, start + lenType[number, particleTypeIndex])
+        with self.stage("halo", int(snapshot)) as record:
+            dfTypes = instance.read_arepo_rows(typeRows)
+            record["rows"] = sum(len(df) for df in dfTypes.values())
+        table = particle_table(sum(len(df) for df in dfTypes.values()), instance.get_float_columns())
+        offset = 0
+        for df in dfTypes.values():
+            table.put_frame(offset, df)
+            offset += len(df)
+        return table.to_frame()
+
+    #returns (ids, halo) of the particles of one snapshot sorted by ParticleID, halo is the number of the group (or subhalo)
+    #holding the particle or -1, from the group offsets; kept per snapshot, as matching joins the sorted arrays again and again
+    def read_membership(self, snapshot, subhalo=False):
+        key = (int(snapshot), subhalo)
+        if key not in self.memberships:
+            self.update_catalogue()
+            instance = self.get_raw_instance(self.get_path_raw(snapshot))
+            if instance.repacked:
+                raise ValueError("snapshot {} is repacked, the group offsets do not apply to its particle order".format(snapshot))
+            with self.stage("membership", int(snapshot)) as record:
+                lenType, offsetType = self.get_gal_instance(self.get_path_gal(snapshot)).read_offsets(subhalo=subhalo)
+                ids = []
+                halo = []
+                for particleTypeIndex, typeIds in instance.read_ids().items():
+                    ids.append(typeIds)
+                    halo.append(get_row_halos(lenType[:, particleTypeIndex], offsetType[:, particleTypeIndex], len(typeIds)))
+                ids = np.concatenate(ids)
+                halo = np.concatenate(halo)
+                order = np.argsort(ids)
+                self.memberships[key] = (ids[order], halo[order])
+                record["rows"] = len(ids)
+        return self.memberships[key]
+
+    #returns dataframe of the particles of the halos of snapFrom found in the halos of snapTo (see halo_transfer)
+    def read_transfer(self, snapFrom, snapTo, subhalo=False):
+        return halo_transfer(self.read_membership(snapFrom, subhalo), self.read_membership(snapTo, subhalo))
+
+    #returns dataframe of merger tree links between consecutive snapshots of the reader, one row per halo of a snapshot
+    #sharing particles with halos of the one before: Snap, Halo, ProgSnap, Progenitor (the halo giving most particles),
+    #NumShared, NumProgenitors and Fraction (NumShared over the members of Halo)
+    def merger_tree(self, subhalo=False):
+        snapshots = sorted(set(int(s) for s in self.snapshots))
+        links = []
+        for progSnap, snap in zip(snapshots[:-1], snapshots[1:]):
+            ids, halo = self.read_membership(snap, subhalo)
+            transfer = halo_transfer((ids, halo), self.read_membership(progSnap, subhalo))
+            transfer = transfer[transfer["HaloTo"] >= 0]
+            numProgenitors = transfer.groupby("HaloFrom").size()
+            main = transfer.sort_values(["HaloFrom", "NumPart"], ascending=[True, False], kind="stable").drop_duplicates("HaloFrom")
+            members = np.bincount(halo[halo >= 0])
+            links.append(pd.DataFrame({"Snap":np.full(len(main), snap, dtype=np.uint16), "Halo":main["HaloFrom"].values,
+                                       "ProgSnap":np.full(len(main), progSnap, dtype=np.uint16), "Progenitor":main["HaloTo"].values,
+                                       "NumShared":main["NumPart"].values, "NumProgenitors":numProgenitors.loc[main["HaloFrom"]].values,
+                                       "Fraction":main["NumPart"].values/members[main["HaloFrom"].values]}))
+        if not links:
+            return pd.DataFrame(columns=["Snap", "Halo", "ProgSnap", "Progenitor", "NumShared", "NumProgenitors", "Fraction"])
+        return pd.concat(links, ignore_index=True)
+
+    #yields dataframes of at most chunkRows rows (or about maxBytes of memory each), one particle type of one file at a time
+    #every batch has the Snap and Type columns, so histograms, counts and selections can run in one pass with bounded memory
+    def iter_raw(self, chunkRows=None, maxBytes=None):
+        self.update_catalogue()
+        for snapshot in self.snapshots:
+            currentPath = self.get_path_raw(snapshot)
+            instance = self.get_raw_instance(currentPath)
+            self.boxSize = instance.boxSize
+            if self.region is not None:
+                instance.region = copy.copy(self.region)
+                if instance.region.boxSize is None:
+                    instance.region.boxSize = self.boxSize
+            for filename in instance.get_snapdirList():
+                if self.region is not None:
+                    entry = self.load_bounds(filename)
+                    if entry is not None:
+                        instance.fileBounds[filename] = entry
+                    if instance.region_misses(filename):
+                        continue
+                for dfBatch in instance.iter_arepo_file(filename, chunkRows, maxBytes):
+                    yield dfBatch
+
+    #reads the snapshots of snapshotRange that are complete on disk but not yet in particles (and groups) and appends them,
+    #returns (particles, groups, new snapshots). Only the new snapshots are read (through the cache if one is set, so they
+    #are kept on disk too), appending copies the frames and index=True rebuilds the spatial index of the result
+    def refresh(self, particles=None, groups=None, index=False):
+        self.update_catalogue()
+        haveRaw = set() if particles is None else set(int(s) for s in np.unique(particles["Snap"].values))
+        haveGal = set() if groups is None else set(int(s) for s in np.unique(groups["Snap"].values))
+        newSnapshots = [int(s) for s in self.snapshots if (int(s) not in haveRaw or int(s) not in haveGal) and self.is_complete(s)]
+        if not newSnapshots:
+            return particles, groups, newSnapshots
+        snapshots = self.snapshots
+        try:
+            self.snapshots = np.array([s for s in newSnapshots if s not in haveRaw])
+            if len(self.snapshots) > 0:
+                dfNew = self.read_arepo_raw()
+                particles = dfNew if particles is None else pd.concat([particles, dfNew])
+                if index == True:
+                    build_spatial_index(particles, self.boxSize)
+            self.snapshots = np.array([s for s in newSnapshots if s not in haveGal])
+            if len(self.snapshots) > 0:
+                dfNew = self.read_arepo_gal()
+                groups = dfNew if groups is None else pd.concat([groups, dfNew], ignore_index=True)
+        finally:
+            self.snapshots = snapshots
+        logger.info("ingested snapshots {}".format(newSnapshots))
+        return particles, groups, newSnapshots
+
+    #refreshes every interval seconds (see refresh) and calls callback(particles, groups, new snapshots) when snapshots came in
+    #stops after maxPolls polls or on KeyboardInterrupt and returns (particles, groups)
+    def watch(self, callback=None, interval=60., particles=None, groups=None, index=False, maxPolls=None):
+        polls = 0
+        try:
+            while maxPolls is None or polls < maxPolls:
+                particles, groups, newSnapshots = self.refresh(particles, groups, index)
+                if newSnapshots and callback is not None:
+                    callback(particles, groups, newSnapshots)
+                polls += 1
+                if maxPolls is None or polls < maxPolls:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            logger.info("stopped watching")
+        return particles, groups
+
+    #returns True if the snapdir and groups dir of snapshot hold all their files, each with the requested blocks fully written
+    #a directory found incomplete in the catalogue is scanned again, as files written in place keep the directory mtime
+    def is_complete(self, snapshot):
+        for rescan in [False, True]:
+            snapEntry = self.get_directory_entry(self.get_path_raw(snapshot), rescan)
+            galEntry = self.get_directory_entry(self.get_path_gal(snapshot), rescan)
+            if snapEntry is not None and galEntry is not None and self.is_complete_raw(snapEntry) and self.is_complete_gal(galEntry):
+                return True
+            if self.catalogue is None:
+                return False
+        return False
+
+    #returns the catalogue entry of a snapdir/groups dir (scanned again if rescan), without catalogue a fresh scan, None if missing
+    def get_directory_entry(self, currentPath, rescan=False):
+        dirName = os.path.basename(currentPath.rstrip("/"))
+        if self.catalogue is None:
+            if not os.path.isdir(currentPath):
+                return None
+            return scan_directory(currentPath.rstrip("/"), os.stat(currentPath).st_mtime_ns)
+        if rescan:
+            return self.catalogue.rescan(dirName)
+        return self.catalogue.get_entry(dirName)
+
+    #returns True if a snapdir entry has NumFilesPerSnapshot files of the fileFormat with all rows of the requested blocks
+    def is_complete_raw(self, snapEntry):
+        files = [f for f in snapEntry["files"] if f["name"].endswith("hdf5") != (self.fileFormat == "gadget")]
+        if not files or len(files) != files[0]["header"]["NumFilesPerSnapshot"]:
+            return False
+        typeIndexes = {"Gas":0, "DM":1, "Darkmatter":1, "Stars":4}
+        for f in files:
+            for particleTypeIndex in [typeIndexes[particleType] for particleType in self.particleTypes]:
+                numRows = f["header"]["NumPart_ThisFile"][particleTypeIndex]
+                if numRows == 0:
+                    continue
+                for blockName in ["ParticleIDs"] + self.blockNames:
+                    if blockName == "Masses" or (blockName == "Density" and particleTypeIndex != 0):
+                        continue
+                    dataset = f["datasets"].get("PartType{}/{}".format(particleTypeIndex, blockName))
+                    if dataset is None or dataset[0][0] != numRows:
+                        return False
+        return True
+
+    #returns True if a groups entry has NumFiles catalogue files with all their groups written
+    def is_complete_gal(self, galEntry):
+        files = [f for f in galEntry["files"] if f["name"].endswith("hdf5")]
+        if not files or len(files) != files[0]["header"]["NumFiles"]:
+            return False
+        for f in files:
+            numGroups = f["header"]["Ngroups_ThisFile"]
+            dataset = f["datasets"].get("Group/GroupPos")
+            if numGroups > 0 and (dataset is None or dataset[0][0] != numGroups):
+                return False
+        return True
+
+    #reads every (snapshot, file) pair, serial or in a process pool if workers is set
+    #results come back in snapshot order, then file order, so both modes give the same df
+    def read_files(self, instances, fileLists, function=None):
+        if function is None:
+            function = read_file
+        taskInstances = []
+        taskFiles = []
+        for instance, fileList in zip(instances, fileLists):
+            for filename in fileList:
+                taskInstances.append(instance)
+                taskFiles.append(filename)
+        if self.stats is not None:
+            return self.read_files_timed(function, taskInstances, taskFiles)
+        if self.workers is None or self.workers <= 1 or len(taskFiles) <= 1:
+            return [function(i, f) for i, f in zip(taskInstances, taskFiles)]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(function, taskInstances, taskFiles))
+
+    #read_files with a "file" record per file, measured where the file is read and added as results come in
+    def read_files_timed(self, function, taskInstances, taskFiles):
+        results = []
+        if self.workers is None or self.workers <= 1 or len(taskFiles) <= 1:
+            for instance, filename in zip(taskInstances, taskFiles):
+                result, record = read_file_timed(function, instance, filename)
+                self.stats.add(record)
+                results.append(result)
+            return results
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for result, record in pool.map(read_file_timed, [function]*len(taskFiles), taskInstances, taskFiles):
+                self.stats.add(record)
+                results.append(result)
+        return results
+
+    #reads snapshots through the cache, one entry per (snapshot, particle type)
+    #only types without a valid entry are read from hdf5, rows come back in the uncached file-then-type order
+    def read_cached_raw(self, instances):
+        dataList = []
+        for instance in instances:
+            fileList = instance.get_snapdirList()
+            entries = {}
+            missing = {}
+            with self.stage("cache", instance.currentSnapshot) as record:
+                for particleTypeIndex in instance.particleTypeIndexes:
+                    key = self.cache.get_key(fileList, "PartType{}".format(particleTypeIndex), self.blockNames, [instance.get_stamp(f) for f in fileList])
+                    entry = self.cache.load(key)
+                    if entry is None:
+                        missing[particleTypeIndex] = key
+                    else:
+                        entries[particleTypeIndex] = entry
+                record["rows"] = sum(len(entry[0]) for entry in entries.values())
+            if missing:
+                missingInstance = copy.copy(instance)
+                missingInstance.particleTypeIndexes = list(missing)
+                fileTypes = self.read_files([missingInstance], [fileList], function=read_file_types)
+                for particleTypeIndex, key in missing.items():
+                    frames = [types[particleTypeIndex] for types in fileTypes if particleTypeIndex in types]
+                    fileCounts = [len(types.get(particleTypeIndex, ())) for types in fileTypes]
+                    dfType = pd.concat(frames, ignore_index=True, sort=True) if frames else pd.DataFrame()
+                    self.cache.store(key, dfType, fileCounts=fileCounts)
+                    entries[particleTypeIndex] = (dfType, {"fileCounts":fileCounts})
+            pieces = []
+            starts = dict.fromkeys(entries, 0)
+            for fileNumber in range(len(fileList)):
+                for particleTypeIndex in instance.particleTypeIndexes:
+                    dfType, meta = entries[particleTypeIndex]
+                    count = meta["fileCounts"][fileNumber]
+                    if count > 0:
+                        pieces.append(dfType.iloc[starts[particleTypeIndex]:starts[particleTypeIndex]+count])
+                        starts[particleTypeIndex] += count
+            dataList.append(pd.concat(pieces, ignore_index=True, sort=True))
+        return dataList
+
+    #reads only the particles inside self.region, files are skipped using per-file bounds from earlier reads
+    #(kept in memory and, with a cache, on disk) and the bounds of files that had to be opened are stored
+    def read_region_raw(self, instances):
+        queryRegion = copy.copy(self.region)
+        if queryRegion.boxSize is None:
+            queryRegion.boxSize = self.boxSize
+        fileLists = []
+        for instance in instances:
+            instance.region = queryRegion
+            fileList = instance.get_snapdirList()
+            for filename in fileList:
+                entry = self.load_bounds(filename)
+                if entry is not None:
+                    instance.fileBounds[filename] = entry
+            fileLists.append(fileList)
+        results = self.read_files(instances, fileLists, function=read_file_region)
+        dataList = []
+        position = 0
+        for fileList in fileLists:
+            frames = []
+            for filename in fileList:
+                dfFileTypes, entry = results[position]
+                position += 1
+                if entry is not None:
+                    self.store_bounds(filename, entry)
+                frames.extend(dfFileTypes.values())
+            dataList.append(pd.concat(frames, ignore_index=True, sort=True))
+        return dataList
+
+    #returns the stored bounds entry of a file if it is still valid for the file on disk
+    def load_bounds(self, filename):
+        entry = self.fileBounds.get(filename)
+        if entry is None and self.cache is not None:
+            entry = self.cache.load_bounds(filename)
+        dirEntry = self.get_catalogue_entry(os.path.dirname(filename))
+        if entry is None and dirEntry is not None:
+            #bounds recorded by the catalogue scan, so even the first region query skips files
+            for f in dirEntry["files"]:
+                if f["name"] == os.path.basename(filename) and "bounds" in f:
+                    entry = {"stamp":f["stamp"], "bounds":f["bounds"]}
+        if entry is None or entry["stamp"] != get_file_stamp(dirEntry, filename):
+            return None
+        return entry
+
+    #keeps the bounds entry of a file, merged with the types already known
+    def store_bounds(self, filename, entry):
+        known = self.load_bounds(filename)
+        if known is not None and known["stamp"] == entry["stamp"]:
+            merged = dict(known["bounds"])
+            merged.update(entry["bounds"])
+            entry = {"stamp":entry["stamp"], "bounds":merged}
+        self.fileBounds[filename] = entry
+        if self.cache is not None:
+            self.cache.store_bounds(filename, entry)
+
+    #reads group catalogues through the cache, one entry per snapshot
+    def read_cached_gal(self, instances):
+        dataList = []
+        for instance in instances:
+            fileList = instance.get_groupdirList()
+            key = self.cache.get_key(fileList, "Group", instance.blockNames, [instance.get_stamp(f) for f in fileList])
+            entry = self.cache.load(key)
+            if entry is None:
+                dfSnap = pd.concat(self.read_files([instance], [fileList]), ignore_index=True)
+                self.cache.store(key, dfSnap)
+            else:
+                dfSnap = entry[0]
+            dataList.append(dfSnap)
+        return dataList
+
+
+
+
+#reads one file with a snapshot_read_raw or snapshot_read_gal instance (module level so it pickles into workers)
+def read_file(instance, filename):
+    return instance.read_arepo_file(filename)
+
+
+#reads one file into the rows from offset of table (a particle_table, or the spec of a shared one in a worker)
+#returns the offset after the file and the read_stats "file" record of the read
+def read_file_into(instance, filename, table, offset):
+    opened = not isinstance(table, particle_table)
+    if opened:
+        table = particle_table(*table)
+    try:
+        stats = read_stats()
+        with stats.stage("file", instance.currentSnapshot, filename) as record:
+            end = instance.read_arepo_into(filename, table, offset)
+            record["rows"] = end - offset
+            record["files"] = 1
+    finally:
+        if opened:
+            table.close()
+    return end, record
+
+
+#reads one file with a snapshot_read_raw instance, split into a dict of particleTypeIndex -> df
+def read_file_types(instance, filename):
+    return instance.read_arepo_file_types(filename)
+
+
+#reads one partition of read_arepo_lazy: the particles of one file (None gives an empty one) as a read_arepo_raw df
+#with only the blocks needed for columns and filters
+def read_lazy_partition(instance, filename, filters=None, columns=None):
+    instance = copy.copy(instance)
+    if columns is not None:
+        needed = set(columns) | set(f[0] for f in filters or [])
+        instance.blockNames = [blockName for blockName in instance.blockNames if set(get_block_columns(blockName)) & needed]
+    table = particle_table(0, instance.get_float_columns())
+    if filename is not None:
+        dfTypes = instance.read_arepo_file_types(filename)
+        table = particle_table(sum(len(df) for df in dfTypes.values()), instance.get_float_columns())
+        offset = 0
+        for df in dfTypes.values():
+            table.put_frame(offset, df)
+            offset += len(df)
+    dfPart = apply_filters(table.to_frame(), filters or [])
+    if columns is not None:
+        dfPart = dfPart[list(columns)]
+    return dfPart
+
+
+#returns the df columns read_arepo_raw makes from one hdf5 block
+def get_block_columns(blockName):
+    blockColumns = {"Coordinates":["posX", "posY", "posZ"], "Velocities":["velX", "velY", "velZ"], "Density":["Dens"], "Masses":["Mass"]}
+    return blockColumns.get(blockName, [])
+
+
+#returns the rows of df that pass every (column, op, value) filter
+def apply_filters(df, filters):
+    ops = {"==":operator.eq, "!=":operator.ne, "<":operator.lt, "<=":operator.le, ">":operator.gt, ">=":operator.ge}
+    keep = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        values = df.index.values if column == "ID" and column not in df.columns else df[column].values
+        if op == "in":
+            keep &= np.isin(values, list(value))
+        else:
+            keep &= ops[op](values, value)
+    return df[keep]
+
+
+#returns True if no position inside the box typeBounds ([lower, upper] of posX/posY/posZ) passes every position filter
+#the bounds are compared as float32, like the position columns they were taken from
+def bounds_miss_filters(typeBounds, filters):
+    ops = {"==":operator.eq, "<":operator.lt, "<=":operator.le, ">":operator.gt, ">=":operator.ge}
+    for column, op, value in filters:
+        if column not in ("posX", "posY", "posZ") or op not in ops:
+            continue
+        axis = ("posX", "posY", "posZ").index(column)
+        lower, upper = np.float32(typeBounds[0][axis]), np.float32(typeBounds[1][axis])
+        if op in ("<", "<=") and not ops[op](lower, value):
+            return True
+        if op in (">", ">=") and not ops[op](upper, value):
+            return True
+        if op == "==" and not (lower <= value and upper >= value):
+            return True
+    return False
+
+
+#returns True for lazy (dask) frames of read_arepo_lazy
+def is_lazy(particles):
+    return hasattr(particles, "__dask_graph__")
+
+
+#reads one file with a snapshot_read_raw instance that has a region set, returns (types, bounds entry of the file)
+def read_file_region(instance, filename):
+    dfFileTypes = instance.read_arepo_file_types(filename)
+    return dfFileTypes, instance.fileBounds.get(filename)
+
+
+#calls function(instance, filename) of read_files, returns (result, read_stats "file" record of the call)
+def read_file_timed(function, instance, filename):
+    stats = read_stats()
+    with stats.stage("file", instance.currentSnapshot, filename) as record:
+        result = function(instance, filename)
+        record["rows"] = count_rows(result)
+        record["files"] = 1
+    return result, record
+
+
+#returns rows of a read_files result: a df, a dict of dfs or a (dict, bounds) tuple
+def count_rows(result):
+    if isinstance(result, tuple):
+        return count_rows(result[0])
+    if isinstance(result, dict):
+        return sum(len(df) for df in result.values())
+    return len(result)
+
+
+#returns bytes read by this process so far (rchar of /proc/self/io, counts page-cache hits too), 0 where it does not exist
+#memory mapped Gadget files are read by page faults and do not show up here
+def get_bytes_read():
+    try:
+        with open("/proc/self/io") as fp:
+            for line in fp:
+                if line.startswith("rchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+#returns chunk number N of a snapshot_XXX.N.hdf5 / fof_subhalo_tab_XXX.N.hdf5 (or Gadget snapshot_XXX.N) filename
+def get_chunk_number(filename):
+    found = re.findall(r"\.(\d+)(\.hdf5)?$", filename)
+    if found:
+        return int(found[0][0])
+    return -1
+
+
+#returns [mtime_ns, size] of filename from a snapshot_catalogue dir entry, or from os.stat without one
+def get_file_stamp(catalogue, filename):
+    if catalogue is not None:
+        name = os.path.basename(filename)
+        for f in catalogue["files"]:
+            if f["name"] == name:
+                return f["stamp"]
+    stat = os.stat(filename)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+#reads a whole dataset (h5py dataset or memmap view) into dest, converting to the dtype of dest on the way
+def read_into(dataset, dest):
+    if len(dest) == 0:
+        return
+    if hasattr(dataset, "read_direct"):
+        dataset.read_direct(dest)
+    else:
+        dest[...] = dataset
+
+
+
+
+#metadata of the snapdir_XXX/groups_XXX directories of a simulation, built in one scan and kept as a JSON sidecar:
+#per chunk file its [mtime_ns, size] stamp, header attributes, top-level groups and dataset shapes/dtypes.
+#update() only rescans directories that are new or whose mtime changed (files added, removed or renamed),
+#files rewritten in place are only noticed with update(verify=True), which stats every file
+class snapshot_catalogue():
+    version = 2
+
+    def __init__(self, path, sidecarPath=None):
+        if path[-1] != "/":
+            path = path + "/"
+        self.path = path
+        self.sidecarPath = sidecarPath if sidecarPath is not None else path + "aiko_catalogue.json"
+        self.dirs = {}
+        self.load()
+
+    #reads the sidecar, a missing or outdated one leaves the catalogue empty
+    def load(self):
+        try:
+            with open(self.sidecarPath) as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.version and data.get("path") == os.path.abspath(self.path):
+            self.dirs = data["dirs"]
+
+    #writes the sidecar (through a temporary file), a read-only location keeps the catalogue in memory only
+    def store(self):
+        tmpPath = "{}.tmp-{}".format(self.sidecarPath, os.getpid())
+        try:
+            with open(tmpPath, "w") as fp:
+                json.dump({"version":self.version, "path":os.path.abspath(self.path), "dirs":self.dirs}, fp)
+            os.replace(tmpPath, self.sidecarPath)
+        except OSError as error:
+            logger.warning("catalogue not stored: {}".format(error))
+
+    #scans new and changed directories, drops removed ones and stores the sidecar if anything changed
+    #names limits the check to those directories ("snapdir_127", "groups_127"), None scans every one under path
+    #returns the names of the scanned directories
+    def update(self, verify=False, names=None):
+        scanned = []
+        if names is None:
+            with os.scandir(self.path) as entries:
+                names = [entry.name for entry in entries if re.match(r"(snapdir|groups)_\d{3}$", entry.name) and entry.is_dir()]
+            removed = [name for name in self.dirs if name not in names]
+        else:
+            present = [name for name in names if os.path.isdir(self.path + name)]
+            removed = [name for name in names if name in self.dirs and name not in present]
+            names = present
+        for name in names:
+            known = self.dirs.get(name)
+            dirPath = self.path + name
+            if known is not None and known["mtime"] == os.stat(dirPath).st_mtime_ns and not (verify and self.is_stale(dirPath, known)):
+                continue
+            if self.rescan(name, store=False) is not None:
+                scanned.append(name)
+        for name in removed:
+            del self.dirs[name]
+        if scanned or removed:
+            self.store()
+        return scanned
+
+    #scans one directory again (files still being written do not change the directory mtime), returns its entry or None
+    def rescan(self, dirName, store=True):
+        dirPath = self.path + dirName
+        dirEntry = None
+        if os.path.isdir(dirPath):
+            dirEntry = scan_directory(dirPath, os.stat(dirPath).st_mtime_ns)
+        if dirEntry is None:
+            self.dirs.pop(dirName, None)
+        else:
+            self.dirs[dirName] = dirEntry
+        if store:
+            self.store()
+        return dirEntry
+
+    #returns True if any file of a dir entry has a different stamp on disk
+    def is_stale(self, dirPath, dirEntry):
+        for f in dirEntry["files"]:
+            try:
+                if get_file_stamp(None, os.path.join(dirPath, f["name"])) != f["stamp"]:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    #returns the entry of a directory ("snapdir_127", "groups_127") or None
+    def get_entry(self, dirName):
+        return self.dirs.get(dirName)
+
+    #returns the sorted snapshot numbers of the snapdir_XXX (or groups_XXX) directories
+    def get_snapshots(self, kind="snapdir"):
+        return sorted(dirEntry["snapshot"] for name, dirEntry in self.dirs.items() if name.startswith(kind + "_"))
+
+
+#returns the catalogue entry of one snapdir/groups directory, None if a file can not be read (yet)
+#hdf5 files are opened with h5py, Gadget files written by hdf5_gadget.py with gadget_file
+def scan_directory(dirPath, mtime):
+    files = []
+    names = [name for name in os.listdir(dirPath) if name.endswith("hdf5") or re.search(r"\_\d{3}\.\d+$", name)]
+    for name in sorted(names, key=get_chunk_number):
+        filename = os.path.join(dirPath, name)
+        try:
+            stat = os.stat(filename)
+            file = h5py.File(filename, "r") if name.endswith("hdf5") else gadget_file(filename)
+            with file:
+                header = {key: to_json_value(value) for key, value in file["/Header"].attrs.items()}
+                groups = list(file)
+                datasets = {}
+                for group in groups:
+                    if group == "Header":
+                        continue
+                    if isinstance(file, gadget_file):
+                        blockNames = [blockName for blockName in gadget_file.blocks if "/{}/{}".format(group, blockName) in file]
+                    else:
+                        blockNames = [blockName for blockName, item in file[group].items() if isinstance(item, h5py.Dataset)]
+                    for blockName in blockNames:
+                        dataset = file["/{}/{}".format(group, blockName)]
+                        datasets[group + "/" + blockName] = [list(dataset.shape), dataset.dtype.str]
+                bounds = get_type_bounds(file, groups)
+        except (OSError, KeyError, ValueError):
+            logger.info("{} not readable (yet), {} left out of the catalogue".format(filename, dirPath))
+            return None
+        files.append({"name":name, "stamp":[stat.st_mtime_ns, stat.st_size], "header":header, "groups":groups, "datasets":datasets, "bounds":bounds})
+    return {"mtime":mtime, "snapshot":int(os.path.basename(dirPath)[-3:]), "files":files}
+
+
+#returns dict of particleTypeIndex (as str) -> [lower, upper] corner of the Coordinates of every part type of a snapshot file,
+#None for empty types, as the region reads keep them; the Coordinates are read in slabs, repacked files keep them in AikoIndex
+def get_type_bounds(file, groups, slabRows=1 << 20):
+    bounds = {}
+    for group in groups:
+        if not group.startswith("PartType") or "/{}/Coordinates".format(group) not in file:
+            continue
+        if "AikoIndex" in groups:
+            index = file["/AikoIndex/" + group]
+            bounds[group[8:]] = [index.attrs["Lower"].tolist(), index.attrs["Upper"].tolist()] if index.attrs["Count"] > 0 else None
+            continue
+        coordinates = file["/{}/Coordinates".format(group)]
+        lower = np.full(3, np.inf)
+        upper = np.full(3, -np.inf)
+        for start in range(0, coordinates.shape[0], slabRows):
+            slabLower, slabUpper = get_bounds(coordinates[start:start+slabRows])
+            lower = np.minimum(lower, slabLower)
+            upper = np.maximum(upper, slabUpper)
+        bounds[group[8:]] = [lower.tolist(), upper.tolist()] if coordinates.shape[0] > 0 else None
+    return bounds
+
+
+#returns [lower, upper] corners of positions (n,3), one column at a time, which is much faster than reducing along axis 0
+def get_bounds(coords):
+    return [[float(coords[:, axis].min()) for axis in range(3)], [float(coords[:, axis].max()) for axis in range(3)]]
+
+
+#returns header attribute values as JSON types
+def to_json_value(value):
+    if isinstance(value, bytes):
+        return value.decode(errors="replace")
+    if isinstance(value, np.ndarray):
+        return [to_json_value(v) for v in value.tolist()] if value.dtype.kind == "S" else value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
 
 
 
 #class for reading snapshot directories, managed by aiko
 class snapshot_read_raw():
     #sets path of snapshot dir (corrects for missing slash at end of path) and other vars
-    def __init__(self, snapPath, blockNames, particleTypes):
-        if snapPath[-1] is not "/":
+    def __init__(self, snapPath, blockNames, particleTypes, region=None, catalogue=None):
+        if snapPath[-1] != "/":
             snapPath = snapPath + "/"
         self.snapPath = snapPath
         self.blockNames = blockNames
         self.particleTypes = particleTypes
+        self.region = region
+        self.fileBounds = {}
+        #snapshot_catalogue entry of the snapdir, headers, file lists and counts then come from it instead of the filesystem
+        self.catalogue = catalogue
         self.particleTypeIndexes = self.get_particleType_index()
-        self.numSnapdirs = self.get_numSnapdirs()
+        header = self.get_header()
+        self.numSnapdirs = header["NumFilesPerSnapshot"]
+        self.boxSize = header["BoxSize"]
+        self.massTable = np.asarray(header["MassTable"], dtype=np.float64)
+        #files rewritten along a space-filling curve by repack.py, region reads then use their cell key table
+        self.repacked = bool(header.get("AikoRepacked", 0))
         self.currentSnapshot = self.get_snapshot()
 
-    #searches for a file with correct name, opens and gets number of snaps from header
-    def get_numSnapdirs(self):
+    #searches for a file with correct name, opens and returns the header attributes as dict
+    def get_header(self):
+        if self.catalogue is not None:
+            return self.get_catalogue_files()[0]["header"]
         for i in os.listdir(self.snapPath):
-            if re.search("\.\d\.", i):
+            if re.search(r"\.\d\.", i):
                 fileName = i
                 break
         filePath = self.snapPath + fileName
-        file = h5py.File(filePath, 'r')
-        attrs = file['/Header'].attrs
-        numFilesPerSnapshot = attrs["NumFilesPerSnapshot"]
-        return numFilesPerSnapshot
+        with h5py.File(filePath, 'r') as file:
+            attrs = dict(file['/Header'].attrs)
+        return attrs
+
+    #searches for a file with correct name, opens and gets number of snaps from header
+    def get_numSnapdirs(self):
+        return self.get_header()["NumFilesPerSnapshot"]
 
     #converts words of particleTypes to particleTypeIndexes
     def get_particleType_index(self):
@@ -117,52 +1000,466 @@ class snapshot_read_raw():
 
     #returns current snapshot
     def get_snapshot(self):
+        if self.catalogue is not None:
+            return self.catalogue["snapshot"]
         for i in os.listdir(self.snapPath):
-            if re.search("\_\d{3}\.", i):
-                snapshot = re.findall("\_\d{3}\.", i)[0][1:4]
+            if re.search(r"\_\d{3}\.", i):
+                snapshot = re.findall(r"\_\d{3}\.", i)[0][1:4]
                 return int(snapshot)
 
-    #returns list of all filenames in dir
+    #returns list of all filenames in dir, sorted by chunk number
     def get_snapdirList(self):
-        return glob.glob(self.snapPath + "*hdf5")
+        if self.catalogue is not None:
+            return [self.snapPath + f["name"] for f in self.get_catalogue_files()]
+        return sorted(glob.glob(self.snapPath + "*hdf5"), key=get_chunk_number)
+
+    #returns True for the names of the snapshot files this reader reads
+    def is_snapshot_file(self, name):
+        return name.endswith("hdf5")
+
+    #returns the catalogue entries of the snapshot files, sorted by chunk number
+    def get_catalogue_files(self):
+        return [f for f in self.catalogue["files"] if self.is_snapshot_file(f["name"])]
+
+    #returns the catalogue entry of one file of the snapshot
+    def get_catalogue_file(self, filename):
+        name = os.path.basename(filename)
+        for f in self.catalogue["files"]:
+            if f["name"] == name:
+                return f
+        raise KeyError("{} is not in the catalogue of {}".format(name, self.snapPath))
+
+    #returns [mtime_ns, size] of one file of the snapshot
+    def get_stamp(self, filename):
+        return get_file_stamp(self.catalogue, filename)
+
+    #opens one file of the snapshot
+    def open_file(self, filename):
+        return h5py.File(filename, "r")
 
     #returns dataframe of snap-particledata
     def read_arepo_snap(self):
         dfSnapList = []
         for filename in self.get_snapdirList():
-            file = h5py.File(filename, "r")
-            dfFileList = []
+            dfSnapList.append(self.read_arepo_file(filename))
+        dfSnap = pd.concat(dfSnapList, ignore_index=True)
+        return dfSnap
+
+    #returns dataframe of the particledata in one file of the snapshot
+    def read_arepo_file(self, filename):
+        dfFileList = list(self.read_arepo_file_types(filename).values())
+        dfFile = pd.concat(dfFileList, sort=True)
+        return dfFile
+
+    #returns dict of particleTypeIndex -> dataframe of the particledata in one file of the snapshot
+    #with a region set only matching rows are kept, and files whose known bounds miss the region are not opened
+    def read_arepo_file_types(self, filename):
+        if self.region is not None and self.region_misses(filename):
+            return {particleTypeIndex: self.build_type(particleTypeIndex, self.empty_blocks()) for particleTypeIndex in self.particleTypeIndexes}
+        with self.open_file(filename) as file:
+            dfFileTypes = {}
+            typeBounds = {}
+            typeList = list(file)
+            for particleTypeIndex in self.particleTypeIndexes:
+                typeStructure = "PartType{}".format(particleTypeIndex)
+                if typeStructure not in typeList:
+                    break
+                if self.region is None:
+                    dfFileTypes[particleTypeIndex] = self.read_arepo_type(file, particleTypeIndex)
+                    continue
+                if self.repacked:
+                    dfFileTypes[particleTypeIndex], typeBounds[str(particleTypeIndex)] = self.read_repacked_type(file, particleTypeIndex)
+                    continue
+                coords = file["/PartType{}/Coordinates".format(particleTypeIndex)][()]
+                knownBounds = self.fileBounds.get(filename, {}).get("bounds", {})
+                if str(particleTypeIndex) in knownBounds:
+                    typeBounds[str(particleTypeIndex)] = knownBounds[str(particleTypeIndex)]
+                else:
+                    typeBounds[str(particleTypeIndex)] = get_bounds(coords) if len(coords) > 0 else None
+                hits = np.flatnonzero(self.region.mask(coords))
+                if len(hits) == 0:
+                    dfFileTypes[particleTypeIndex] = self.build_type(particleTypeIndex, self.empty_blocks())
+                    continue
+                rows = slice(hits[0], hits[-1]+1)
+                dfFileTypes[particleTypeIndex] = self.read_arepo_type(file, particleTypeIndex, rows, hits-hits[0], {"Coordinates":coords[hits]})
+        if self.region is not None:
+            self.fileBounds[filename] = {"stamp":self.get_stamp(filename), "bounds":typeBounds}
+        return dfFileTypes
+
+    #returns (dataframe, bounds) of the region rows of one type of a repacked file
+    #only the row ranges of the key table cells overlapping the region are read, the bounds are stored with the table
+    def read_repacked_type(self, file, particleTypeIndex):
+        index = file["/AikoIndex/PartType{}".format(particleTypeIndex)]
+        typeBounds = None
+        if index.attrs["Count"] > 0:
+            typeBounds = [index.attrs["Lower"].tolist(), index.attrs["Upper"].tolist()]
+        cellKeys = index["CellKeys"][()]
+        cellOffsets = index["CellOffsets"][()]
+        regionKeys = get_morton_keys(self.region.cells(file["/AikoIndex"].attrs["CellBits"], file["/AikoIndex"].attrs["BoxSize"]))
+        picked = np.flatnonzero(np.isin(cellKeys, regionKeys))
+        frames = []
+        if len(picked) > 0:
+            starts = cellOffsets[picked]
+            stops = cellOffsets[picked+1]
+            #neighbouring cells along the curve are merged into one read
+            breaks = np.flatnonzero(starts[1:] != stops[:-1]) + 1
+            coordinates = file["/PartType{}/Coordinates".format(particleTypeIndex)]
+            for start, stop in zip(starts[np.r_[0, breaks]], stops[np.r_[breaks-1, len(stops)-1]]):
+                rows = slice(int(start), int(stop))
+                coords = coordinates[rows]
+                hits = np.flatnonzero(self.region.mask(coords))
+                if len(hits) > 0:
+                    frames.append(self.read_arepo_type(file, particleTypeIndex, rows, hits, {"Coordinates":coords[hits]}))
+        if not frames:
+            return self.build_type(particleTypeIndex, self.empty_blocks()), typeBounds
+        return pd.concat(frames), typeBounds
+
+    #yields dataframes of one particle type of the file in slabs of chunkRows rows (or about maxBytes each)
+    def iter_arepo_file(self, filename, chunkRows=None, maxBytes=None):
+        with self.open_file(filename) as file:
+            typeList = list(file)
+            for particleTypeIndex in self.particleTypeIndexes:
+                typeStructure = "PartType{}".format(particleTypeIndex)
+                if typeStructure not in typeList:
+                    break
+                numRows = file["/PartType{}/ParticleIDs".format(particleTypeIndex)].shape[0]
+                step = self.get_chunk_rows(file, particleTypeIndex, chunkRows, maxBytes)
+                for start in range(0, numRows, step):
+                    rows = slice(start, min(start+step, numRows))
+                    if self.region is None:
+                        yield self.read_arepo_type(file, particleTypeIndex, rows)
+                        continue
+                    coords = file["/PartType{}/Coordinates".format(particleTypeIndex)][rows]
+                    hits = np.flatnonzero(self.region.mask(coords))
+                    if len(hits) > 0:
+                        yield self.read_arepo_type(file, particleTypeIndex, rows, hits, {"Coordinates":coords[hits]})
+
+    #returns rows per slab: chunkRows, or as many rows as fit into maxBytes (raw read plus float32 columns), or all
+    def get_chunk_rows(self, file, particleTypeIndex, chunkRows=None, maxBytes=None):
+        if chunkRows is not None:
+            return max(int(chunkRows), 1)
+        if maxBytes is None:
+            return max(file["/PartType{}/ParticleIDs".format(particleTypeIndex)].shape[0], 1)
+        rowBytes = 12
+        for blockName in set(self.blockNames + ["Coordinates", "ParticleIDs"]):
+            h5Path = "/PartType{}/{}".format(particleTypeIndex, blockName)
+            if h5Path in file:
+                dataset = file[h5Path]
+                width = int(np.prod(dataset.shape[1:]))
+                rowBytes += (dataset.dtype.itemsize + 4)*width
+        return max(int(maxBytes//rowBytes), 1)
+
+    #returns dict of particleTypeIndex -> ParticleIDs of the whole snapshot in file order, in their stored integer type
+    def read_ids(self):
+        parts = {particleTypeIndex: [] for particleTypeIndex in self.particleTypeIndexes}
+        for filename in self.get_snapdirList():
+            with self.open_file(filename) as file:
+                for particleTypeIndex in self.particleTypeIndexes:
+                    h5Path = "/PartType{}/ParticleIDs".format(particleTypeIndex)
+                    if h5Path in file:
+                        parts[particleTypeIndex].append(file[h5Path][()])
+        return {particleTypeIndex: np.concatenate(part) if part else np.zeros(0, dtype=np.uint64) for particleTypeIndex, part in parts.items()}
+
+    #returns (n_files, 6) array of NumPart_ThisFile of every file in fileList, read once per instance
+    def get_counts_table(self, fileList):
+        if getattr(self, "countsTable", None) is None:
+            counts = []
+            for filename in fileList:
+                if self.catalogue is not None:
+                    counts.append(np.asarray(self.get_catalogue_file(filename)["header"]["NumPart_ThisFile"][:6], dtype=np.int64))
+                    continue
+                with self.open_file(filename) as file:
+                    counts.append(np.asarray(file["/Header"].attrs["NumPart_ThisFile"][:6], dtype=np.int64))
+            self.countsTable = np.array(counts, dtype=np.int64).reshape(len(fileList), 6)
+        return self.countsTable
+
+    #returns dict of particleTypeIndex -> dataframe of the rows start:stop of each type in typeRows
+    #rows count particles of one type over the whole snapshot in file order, only files holding them are opened
+    def read_arepo_rows(self, typeRows):
+        fileList = self.get_snapdirList()
+        fileCounts = self.get_counts_table(fileList)
+        fileStarts = np.cumsum(fileCounts, axis=0) - fileCounts
+        frames = {particleTypeIndex: [] for particleTypeIndex in typeRows}
+        for fileNumber, filename in enumerate(fileList):
+            fileRows = {}
+            for particleTypeIndex, (start, stop) in typeRows.items():
+                lo = max(start - fileStarts[fileNumber, particleTypeIndex], 0)
+                hi = min(stop - fileStarts[fileNumber, particleTypeIndex], fileCounts[fileNumber, particleTypeIndex])
+                if hi > lo:
+                    fileRows[particleTypeIndex] = slice(int(lo), int(hi))
+            if not fileRows:
+                continue
+            with self.open_file(filename) as file:
+                for particleTypeIndex, rows in fileRows.items():
+                    frames[particleTypeIndex].append(self.read_arepo_type(file, particleTypeIndex, rows))
+        dfTypes = {}
+        for particleTypeIndex, frameList in frames.items():
+            if not frameList:
+                frameList = [self.build_type(particleTypeIndex, self.empty_blocks())]
+            dfTypes[particleTypeIndex] = pd.concat(frameList, ignore_index=True)
+        return dfTypes
+
+    #returns True if the known bounds of every requested type in the file miss the region
+    def region_misses(self, filename):
+        entry = self.fileBounds.get(filename)
+        if entry is None:
+            return False
+        for particleTypeIndex in self.particleTypeIndexes:
+            if str(particleTypeIndex) not in entry["bounds"]:
+                return False
+            typeBounds = entry["bounds"][str(particleTypeIndex)]
+            if typeBounds is not None and self.region.intersects(typeBounds[0], typeBounds[1]):
+                return False
+        return True
+
+    #returns True if the known bounds of every requested type in the file rule out the posX/posY/posZ filters
+    def filters_miss(self, filename, filters):
+        entry = self.fileBounds.get(filename)
+        if entry is None:
+            return False
+        for particleTypeIndex in self.particleTypeIndexes:
+            if str(particleTypeIndex) not in entry["bounds"]:
+                return False
+            typeBounds = entry["bounds"][str(particleTypeIndex)]
+            if typeBounds is not None and not bounds_miss_filters(typeBounds, filters):
+                return False
+        return True
+
+    #returns dataframe of one particle type, rows is a slice of the datasets and select picks rows inside that slice
+    #known holds blocks already read (and selected), e.g. the Coordinates a region read masked, they are not read again
+    def read_arepo_type(self, file, particleTypeIndex, rows=slice(None), select=None, known=None):
+        blocks = dict(known or {})
+        for blockName in self.blockNames + ["ParticleIDs"]:
+            if blockName == "Density" and particleTypeIndex != 0 or blockName in blocks:
+                continue
+            h5Path = "/PartType{}/{}".format(particleTypeIndex, blockName)
+            if h5Path not in file:
+                continue
+            data = file[h5Path][rows]
+            if select is not None:
+                data = data[select]
+            blocks[blockName] = data
+        return self.build_type(particleTypeIndex, blocks)
+
+    #returns zero-length blocks, used for files skipped by a region read
+    def empty_blocks(self):
+        return {"Coordinates":np.zeros((0,3)), "Velocities":np.zeros((0,3)), "Density":np.zeros(0), "Masses":np.zeros(0), "ParticleIDs":np.zeros(0)}
+
+    #returns the float32 columns read_arepo_raw produces for the blockNames and particleTypes
+    def get_float_columns(self):
+        columns = []
+        if "Coordinates" in self.blockNames:
+            columns += ["posX", "posY", "posZ"]
+        if "Velocities" in self.blockNames:
+            columns += ["velX", "velY", "velZ"]
+        if "Density" in self.blockNames and 0 in self.particleTypeIndexes:
+            columns.append("Dens")
+        if "Masses" in self.blockNames:
+            columns.append("Mass")
+        return columns
+
+    #returns dict of particleTypeIndex -> number of particles in the file (from the header)
+    def get_file_counts(self, filename):
+        if self.catalogue is not None:
+            entry = self.get_catalogue_file(filename)
+            return self.get_type_counts(entry["header"]["NumPart_ThisFile"], entry["groups"])
+        with self.open_file(filename) as file:
+            return self.get_type_counts(file["/Header"].attrs["NumPart_ThisFile"], list(file))
+
+    #returns dict of particleTypeIndex -> numPart of the requested types, up to the first type missing from typeList
+    def get_type_counts(self, numPart, typeList):
+        counts = {}
+        for particleTypeIndex in self.particleTypeIndexes:
+            if "PartType{}".format(particleTypeIndex) not in typeList:
+                break
+            counts[particleTypeIndex] = int(numPart[particleTypeIndex])
+        return counts
+
+    #reads the particles of one file into table rows starting at offset, returns the offset after the file
+    #blocks are converted to float32 by hdf5 while reading, so no full-size float64 copy is made
+    def read_arepo_into(self, filename, table, offset):
+        with self.open_file(filename) as file:
+            numPart = file["/Header"].attrs["NumPart_ThisFile"]
             typeList = list(file)
             for particleTypeIndex in self.particleTypeIndexes:
                 typeStructure = "PartType{}".format(particleTypeIndex)
                 if typeStructure not in typeList:
                     break
-                dfStructure = {}
+                numRows = int(numPart[particleTypeIndex])
+                if numRows == 0:
+                    continue
+                if offset + numRows > table.numRows:
+                    raise ValueError("{} holds more particles than counted for the table, files changed while reading".format(filename))
+                rows = slice(offset, offset+numRows)
                 for blockName in self.blockNames:
                     h5Path = "/PartType{}/{}".format(particleTypeIndex, blockName)
-                    if blockName == "Coordinates":
-                        coords = np.float32(file[h5Path].value)
-                        dfStructure["posX"] = coords[:,0]
-                        dfStructure["posY"] = coords[:,1]
-                        dfStructure["posZ"] = coords[:,2]
-                    if blockName == "Velocities":
-                        vels = np.float32(file[h5Path].value)
-                        dfStructure["velX"] = vels[:,0]
-                        dfStructure["velY"] = vels[:,1]
-                        dfStructure["velZ"] = vels[:,2]
+                    if blockName == "Coordinates" or blockName == "Velocities":
+                        vectors = np.empty((numRows, 3), dtype=np.float32)
+                        read_into(file[h5Path], vectors)
+                        prefix = "pos" if blockName == "Coordinates" else "vel"
+                        table.column(prefix + "X")[rows] = vectors[:,0]
+                        table.column(prefix + "Y")[rows] = vectors[:,1]
+                        table.column(prefix + "Z")[rows] = vectors[:,2]
                     if blockName == "Density" and particleTypeIndex == 0:
-                        dens = np.float32(file[h5Path].value)
-                        dfStructure["Dens"] = dens
-                ID = np.uint32(file["/PartType{}/{}".format(particleTypeIndex, "ParticleIDs")].value)
-                dfStructure["ID"] = ID
-                dfStructure["Snap"] = ID*0+self.currentSnapshot
-                dfStructure["Type"] = ID*0+particleTypeIndex
-                dfCurrent = pd.DataFrame(dfStructure)
-                dfFileList.append(dfCurrent)
-            dfFile = pd.concat(dfFileList, sort=True)
-            dfSnapList.append(dfFile)
-        dfSnap = pd.concat(dfSnapList, ignore_index=True)
-        return dfSnap
+                        read_into(file[h5Path], table.column("Dens")[rows])
+                    if blockName == "Masses":
+                        if h5Path in file:
+                            read_into(file[h5Path], table.column("Mass")[rows])
+                        else:
+                            table.column("Mass")[rows] = self.massTable[particleTypeIndex]
+                if "Dens" in table.floatColumns and particleTypeIndex != 0:
+                    table.column("Dens")[rows] = np.nan
+                ID = file["/PartType{}/ParticleIDs".format(particleTypeIndex)][()]
+                np.copyto(table.ID[rows], ID, casting="unsafe")
+                table.Snap[rows] = self.currentSnapshot
+                table.Type[rows] = particleTypeIndex
+                offset += numRows
+        return offset
+
+    #returns dataframe of one particle type from a dict of blockName -> array
+    def build_type(self, particleTypeIndex, blocks):
+        dfStructure = {}
+        for blockName in self.blockNames:
+            if blockName == "Coordinates":
+                coords = np.asarray(blocks[blockName], dtype=np.float32)
+                dfStructure["posX"] = coords[:,0]
+                dfStructure["posY"] = coords[:,1]
+                dfStructure["posZ"] = coords[:,2]
+            if blockName == "Velocities":
+                vels = np.asarray(blocks[blockName], dtype=np.float32)
+                dfStructure["velX"] = vels[:,0]
+                dfStructure["velY"] = vels[:,1]
+                dfStructure["velZ"] = vels[:,2]
+            if blockName == "Density" and particleTypeIndex == 0:
+                dens = np.asarray(blocks[blockName], dtype=np.float32)
+                dfStructure["Dens"] = dens
+        ID = np.asarray(blocks["ParticleIDs"]).astype(np.uint32, copy=False)
+        if "Masses" in self.blockNames:
+            #types without a Masses dataset have their mass in the header MassTable
+            if "Masses" in blocks:
+                dfStructure["Mass"] = np.asarray(blocks["Masses"], dtype=np.float32)
+            else:
+                dfStructure["Mass"] = np.full(len(ID), self.massTable[particleTypeIndex], dtype=np.float32)
+        dfStructure["ID"] = ID
+        dfStructure["Snap"] = np.full(len(ID), self.currentSnapshot, dtype=np.uint16)
+        dfStructure["Type"] = np.full(len(ID), particleTypeIndex, dtype=np.uint8)
+        dfCurrent = pd.DataFrame(dfStructure)
+        return dfCurrent
+
+
+
+
+#class for reading Gadget format-2 snapshots written by hdf5_gadget.py, managed by aiko
+#same interface as snapshot_read_raw, files are opened as gadget_file memory maps instead of hdf5
+class snapshot_read_gadget(snapshot_read_raw):
+    #returns header attributes of the first file as dict
+    def get_header(self):
+        if self.catalogue is not None:
+            return snapshot_read_raw.get_header(self)
+        with self.open_file(self.get_snapdirList()[0]) as file:
+            attrs = dict(file['/Header'].attrs)
+        return attrs
+
+    #returns list of all snapshot_XXX.N files in dir, sorted by chunk number
+    def get_snapdirList(self):
+        if self.catalogue is not None:
+            return snapshot_read_raw.get_snapdirList(self)
+        fileList = [self.snapPath + i for i in os.listdir(self.snapPath) if self.is_snapshot_file(i)]
+        return sorted(fileList, key=get_chunk_number)
+
+    #returns True for snapshot_XXX.N names
+    def is_snapshot_file(self, name):
+        return re.search(r"\_\d{3}\.\d+$", name) is not None
+
+    #opens one file of the snapshot
+    def open_file(self, filename):
+        return gadget_file(filename)
+
+    #returns the memmap view of one block (hdf5 block name, e.g. "Coordinates") of one particle type in one file
+    def get_block(self, filename, blockName, particleTypeIndex):
+        return gadget_file(filename)["/PartType{}/{}".format(particleTypeIndex, blockName)]
+
+
+
+
+#Gadget format-2 file (as written by hdf5_gadget.py) as np.memmap views
+#parses the block headers once and answers the h5py.File lookups the raw reader uses:
+#file["/Header"].attrs, file["/PartTypeN/<hdf5 block name>"], "path" in file and list(file)
+class gadget_file():
+    #hdf5 block name -> (format-2 label, part types in the block, values per particle, dtype)
+    blocks = {"Coordinates":("POS ", None, 3, np.float32), "Velocities":("VEL ", None, 3, np.float32),
+              "ParticleIDs":("ID  ", None, 1, np.uint32), "Masses":("MASS", None, 1, np.float32),
+              "InternalEnergy":("U   ", [0], 1, np.float32), "Density":("RHO ", [0], 1, np.float32),
+              "ElectronAbundance":("NE  ", [0], 1, np.float32), "NeutralHydrogenAbundance":("NH  ", [0], 1, np.float32),
+              "SmoothingLength":("HSML", [0], 1, np.float32), "StarFormationRate":("SFR ", [0], 1, np.float32),
+              "GFM_Metallicity":("Z   ", [0, 4], 1, np.float32), "GFM_StellarFormationTime":("AGE ", [4], 1, np.float32)}
+    headerType = np.dtype([("NumPart_ThisFile", "<i4", 6), ("MassTable", "<f8", 6), ("Time", "<f8"), ("Redshift", "<f8"),
+                           ("FlagSfr", "<i4"), ("FlagFeedback", "<i4"), ("NumPart_Total", "<i4", 6), ("FlagCooling", "<i4"),
+                           ("NumFilesPerSnapshot", "<i4"), ("BoxSize", "<f8"), ("Omega0", "<f8"), ("OmegaLambda", "<f8"),
+                           ("HubbleParam", "<f8")])
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.uint8, mode="r")
+        self.labels = {}
+        position = 0
+        while position + 20 <= len(self.data):
+            label = bytes(self.data[position+4:position+8]).decode()
+            size = int(self.data[position+16:position+20].view("<u4")[0])
+            self.labels[label] = (position+20, size)
+            position += 20 + size + 4
+        start, size = self.labels["HEAD"]
+        header = self.data[start:start+self.headerType.itemsize].view(self.headerType)[0]
+        self.attrs = {name: header[name] for name in self.headerType.names}
+        self.numPart = np.asarray(self.attrs["NumPart_ThisFile"], dtype=np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data = None
+
+    #part type groups the converter always writes (0-3) plus the filled ones
+    def __iter__(self):
+        for particleTypeIndex in range(6):
+            if particleTypeIndex <= 3 or self.numPart[particleTypeIndex] > 0:
+                yield "PartType{}".format(particleTypeIndex)
+
+    def __contains__(self, path):
+        try:
+            self.locate(path)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, path):
+        if path.strip("/") == "Header":
+            return self
+        label, particleTypeIndex, types, width, dtype = self.locate(path)
+        start, size = self.labels[label]
+        skip = int(sum(self.numPart[t] for t in types if t < particleTypeIndex))
+        count = int(self.numPart[particleTypeIndex])
+        itemSize = np.dtype(dtype).itemsize*width
+        view = self.data[start+skip*itemSize:start+(skip+count)*itemSize].view(dtype)
+        if width > 1:
+            view = view.reshape(count, width)
+        return view
+
+    #returns (label, particleTypeIndex, types in block, width, dtype) of "/PartTypeN/<block name>", KeyError if not in the file
+    def locate(self, path):
+        parts = path.strip("/").split("/")
+        if len(parts) != 2 or not parts[0].startswith("PartType") or parts[1] not in self.blocks:
+            raise KeyError(path)
+        particleTypeIndex = int(parts[0][8:])
+        label, types, width, dtype = self.blocks[parts[1]]
+        if types is None:
+            types = list(range(6))
+        if label not in self.labels or particleTypeIndex not in types:
+            raise KeyError(path)
+        return label, particleTypeIndex, types, width, dtype
 
 
 
@@ -170,28 +1467,40 @@ class snapshot_read_raw():
 #class for reading snapshot galaxy data, managed by aiko
 class snapshot_read_gal():
     #sets path of snapshot dir (corrects for missing slash at end of path) and other vars
-    def __init__(self, groupPath, blockNames):
-        if groupPath[-1] is not "/":
+    def __init__(self, groupPath, blockNames, catalogue=None):
+        if groupPath[-1] != "/":
             groupPath = groupPath + "/"
         self.groupPath = groupPath
         self.blockNames = self.convert_blockNames(blockNames)
+        #snapshot_catalogue entry of the groups dir, see snapshot_read_raw
+        self.catalogue = catalogue
         self.numGroupdirs = self.get_numGroupdirs()
         self.currentSnapshot = self.get_snapshot()
 
     #searches for a file with correct name, opens and gets number of snaps from header
     def get_numGroupdirs(self):
+        if self.catalogue is not None:
+            return len(self.catalogue["files"])
         return len(os.listdir(self.groupPath))
 
     #returns current snapshot
     def get_snapshot(self):
+        if self.catalogue is not None:
+            return self.catalogue["snapshot"]
         for i in os.listdir(self.groupPath):
-            if re.search("\_\d{3}\.", i):
-                snapshot = re.findall("\_\d{3}\.", i)[0][1:4]
+            if re.search(r"\_\d{3}\.", i):
+                snapshot = re.findall(r"\_\d{3}\.", i)[0][1:4]
                 return int(snapshot)
 
-    #returns list of all filenames in dir
+    #returns list of all filenames in dir, sorted by chunk number
     def get_groupdirList(self):
-        return glob.glob(self.groupPath + "*hdf5")
+        if self.catalogue is not None:
+            return [self.groupPath + f["name"] for f in self.catalogue["files"] if f["name"].endswith("hdf5")]
+        return sorted(glob.glob(self.groupPath + "*hdf5"), key=get_chunk_number)
+
+    #returns [mtime_ns, size] of one file of the catalogue
+    def get_stamp(self, filename):
+        return get_file_stamp(self.catalogue, filename)
 
     #returns converted list of grouppath
     def convert_blockNames(self, blockNames):
@@ -208,40 +1517,612 @@ class snapshot_read_gal():
             newBlock.append("GroupMass")
         return newBlock
 
+    #returns (lenType, offsetType), (n, 6) int64 arrays of the particles of every group (or subhalo) per type
+    #the offsets count particles of one type over the whole snapshot in file order, where particles are ordered by group
+    #catalogues without offset blocks get them from the lengths (groups) or from the group offsets (subhalos)
+    def read_offsets(self, subhalo=False):
+        prefix = "Subhalo" if subhalo else "Group"
+        blocks = {}
+        for filename in self.get_groupdirList():
+            with h5py.File(filename, "r") as file:
+                for name in ["GroupLenType", "GroupOffsetType", "SubhaloLenType", "SubhaloOffsetType", "SubhaloGrNr", "SubhaloGroupNr", "GroupFirstSub"]:
+                    h5Path = "/{}/{}".format(name[:5] if name.startswith("Group") else "Subhalo", name)
+                    if h5Path in file and file[h5Path].shape[0] > 0:
+                        blocks.setdefault(name, []).append(file[h5Path][()])
+        blocks = {name: np.concatenate(values) for name, values in blocks.items()}
+        lenType = np.asarray(blocks.get(prefix + "LenType", np.zeros((0, 6))), dtype=np.int64)
+        if prefix + "OffsetType" in blocks:
+            return lenType, np.asarray(blocks[prefix + "OffsetType"], dtype=np.int64)
+        groupLen = np.asarray(blocks.get("GroupLenType", np.zeros((0, 6))), dtype=np.int64)
+        groupOffset = np.asarray(blocks.get("GroupOffsetType", np.cumsum(groupLen, axis=0) - groupLen), dtype=np.int64)
+        if not subhalo:
+            return lenType, groupOffset
+        groupNumber = blocks.get("SubhaloGrNr", blocks.get("SubhaloGroupNr"))
+        if groupNumber is None or "GroupFirstSub" not in blocks:
+            raise KeyError("{} has no SubhaloOffsetType and no SubhaloGrNr/GroupFirstSub to derive it".format(self.groupPath))
+        groupNumber = np.asarray(groupNumber, dtype=np.int64)
+        before = np.cumsum(lenType, axis=0) - lenType
+        firstSub = np.asarray(blocks["GroupFirstSub"], dtype=np.int64)[groupNumber]
+        offsetType = groupOffset[groupNumber] + before - before[firstSub]
+        return lenType, offsetType
+
     #returns dataframe of snap-particledata
     def read_arepo_gal(self):
         dfFileList = []
         for filename in self.get_groupdirList():
-            file = h5py.File(filename, "r")
+            dfFileList.append(self.read_arepo_file(filename))
+        dfSnap = pd.concat(dfFileList, ignore_index=True)
+        return dfSnap
+
+    #returns dataframe of the group data in one file of the snapshot
+    def read_arepo_file(self, filename):
+        with h5py.File(filename, "r") as file:
             dfStructure = {}
             for blockName in self.blockNames:
                 h5Path = "/Group/{}".format(blockName)
                 if blockName == "GroupPos":
-                    coords = np.float32(file[h5Path].value)
+                    coords = np.float32(file[h5Path][()])
                     dfStructure["posX"] = coords[:,0]
                     dfStructure["posY"] = coords[:,1]
                     dfStructure["posZ"] = coords[:,2]
                 if blockName == "GroupVel":
-                    vels = np.float32(file[h5Path].value)
+                    vels = np.float32(file[h5Path][()])
                     dfStructure["velX"] = vels[:,0]
                     dfStructure["velY"] = vels[:,1]
                     dfStructure["velZ"] = vels[:,2]
                 if blockName == "GroupCM":
-                    CM = np.float32(file[h5Path].value)
+                    CM = np.float32(file[h5Path][()])
                     dfStructure["CMX"] = CM[:,0]
                     dfStructure["CMY"] = CM[:,1]
                     dfStructure["CMZ"] = CM[:,2]
                 if blockName == "Group_R_Crit200":
-                    radius = np.float32(file[h5Path].value)
+                    radius = np.float32(file[h5Path][()])
                     dfStructure["Radius"] = radius
                 if blockName == "GroupMass":
-                    groupMass = np.float32(file[h5Path].value)
+                    groupMass = np.float32(file[h5Path][()])
                     dfStructure["Mass"] = groupMass
             dfStructure["Snap"] = radius*0+self.currentSnapshot
             dfCurrent = pd.DataFrame(dfStructure)
-            dfFileList.append(dfCurrent)
-        dfSnap = pd.concat(dfFileList, ignore_index=True)
-        return dfSnap
+        return dfCurrent
+
+
+
+
+#timing and I/O records of the reader pipeline: one record per stage (open, count, read, file, concat, index, halo, cache)
+#of a snapshot or file with elapsed seconds, bytes read, rows produced and files touched. callback(record) is called
+#for every finished record, so it can drive a progress bar. Pass an instance (or True) as arepo_reader(stats=...)
+class read_stats():
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.records = []
+
+    #times the with-block as stage, bytes are measured, the yielded record takes rows and files
+    @contextlib.contextmanager
+    def stage(self, name, snapshot=None, filename=None):
+        record = {"stage":name, "snapshot":snapshot, "file":filename, "elapsed":0., "bytes":0, "rows":0, "files":0}
+        start = time.perf_counter()
+        startBytes = get_bytes_read()
+        try:
+            yield record
+        finally:
+            record["elapsed"] = time.perf_counter() - start
+            record["bytes"] += get_bytes_read() - startBytes
+            self.add(record)
+
+    #keeps a finished record (also ones measured in worker processes) and passes it on to the callback
+    def add(self, record):
+        self.records.append(record)
+        logger.debug("{stage} snapshot={snapshot} file={file}: {elapsed:.4f} s, {bytes} bytes, {rows} rows".format(**record))
+        if self.callback is not None:
+            self.callback(record)
+
+    #returns dict of stage -> totals of elapsed, bytes, rows, files and the number of records
+    def summary(self):
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record["stage"], {"elapsed":0., "bytes":0, "rows":0, "files":0, "count":0})
+            for key in ["elapsed", "bytes", "rows", "files"]:
+                total[key] += record[key]
+            total["count"] += 1
+        return totals
+
+    #returns the report as dict: totals per stage and per snapshot, and all records
+    def to_dict(self):
+        snapshots = {}
+        for record in self.records:
+            if record["snapshot"] is None:
+                continue
+            total = snapshots.setdefault(str(record["snapshot"]), {"elapsed":0., "bytes":0, "rows":0, "files":0})
+            for key in ["elapsed", "bytes", "rows", "files"]:
+                total[key] += record[key]
+        return {"stages":self.summary(), "snapshots":snapshots, "records":list(self.records)}
+
+    #returns the report as JSON, also written to path if given
+    def to_json(self, path=None):
+        report = json.dumps(self.to_dict(), indent=1)
+        if path is not None:
+            with open(path, "w") as fp:
+                fp.write(report)
+        return report
+
+    #drops all records
+    def clear(self):
+        self.records = []
+
+
+
+
+#preallocated column buffers of the read_arepo_raw df: one float32 block (one row per column),
+#uint32 IDs (the df index), uint16 Snap and uint8 Type. to_frame wraps the buffers without copying the float block
+class particle_table():
+    #with shared the arrays live in one multiprocessing shared memory block, which workers open by its sharedName
+    def __init__(self, numRows, floatColumns, shared=False, sharedName=None):
+        self.numRows = numRows
+        self.floatColumns = sorted(floatColumns)
+        self.shared = None
+        layout = [((len(self.floatColumns), numRows), np.float32), ((numRows,), np.uint32), ((numRows,), np.uint16), ((numRows,), np.uint8)]
+        if not shared and sharedName is None:
+            self.floats, self.ID, self.Snap, self.Type = [np.empty(shape, dtype=dtype) for shape, dtype in layout]
+            return
+        size = sum(int(np.prod(shape))*np.dtype(dtype).itemsize for shape, dtype in layout)
+        if sharedName is None:
+            self.shared = multiprocessing.shared_memory.SharedMemory(create=True, size=max(size, 1))
+        else:
+            self.shared = multiprocessing.shared_memory.SharedMemory(name=sharedName)
+        arrays = []
+        offset = 0
+        for shape, dtype in layout:
+            arrays.append(np.ndarray(shape, dtype=dtype, buffer=self.shared.buf, offset=offset))
+            offset += int(np.prod(shape))*np.dtype(dtype).itemsize
+        self.floats, self.ID, self.Snap, self.Type = arrays
+
+    #returns the arguments a worker opens this shared table with
+    def get_spec(self):
+        return (self.numRows, self.floatColumns, False, self.shared.name)
+
+    #releases the shared memory block (and removes it if unlink, done by the process that made it)
+    def close(self, unlink=False):
+        if self.shared is None:
+            return
+        self.floats = self.ID = self.Snap = self.Type = None
+        self.shared.close()
+        if unlink:
+            self.shared.unlink()
+        self.shared = None
+
+    #returns the writable buffer of one float column
+    def column(self, name):
+        return self.floats[self.floatColumns.index(name)]
+
+    #copies a reader df (ID as column or index) into the rows starting at offset, missing float columns become NaN
+    def put_frame(self, offset, df):
+        rows = slice(offset, offset+len(df))
+        for k, name in enumerate(self.floatColumns):
+            if name in df.columns:
+                self.floats[k, rows] = df[name].values
+            else:
+                self.floats[k, rows] = np.nan
+        if "ID" in df.columns:
+            np.copyto(self.ID[rows], df["ID"].values, casting="unsafe")
+        else:
+            np.copyto(self.ID[rows], df.index.values, casting="unsafe")
+        self.Snap[rows] = df["Snap"].values
+        self.Type[rows] = df["Type"].values
+
+    #returns the df indexed by ID, columns in the sorted order the old concat produced
+    #a shared table is copied out, so the frame outlives the shared memory block
+    def to_frame(self):
+        copied = self.shared is not None
+        dfAll = pd.DataFrame(self.floats.T, columns=self.floatColumns, index=pd.Index(self.ID, name="ID", copy=copied), copy=copied)
+        for name in ["Snap", "Type"]:
+            position = sum(1 for column in dfAll.columns if column < name)
+            dfAll.insert(position, name, getattr(self, name).copy() if copied else getattr(self, name))
+        return dfAll
+
+
+
+
+#region for reads: a box (|pos-center| < halfWidth on every axis) or a sphere (|pos-center| < radius)
+#with boxSize set, distances are taken across the periodic box edges
+class region():
+    def __init__(self, center, halfWidth=None, radius=None, boxSize=None):
+        if (halfWidth is None) == (radius is None):
+            raise ValueError("region needs either halfWidth or radius")
+        self.center = np.asarray(center, dtype=np.float64)
+        self.halfWidth = halfWidth
+        self.radius = radius
+        self.boxSize = boxSize
+
+    #returns minimum-image offsets pos-center
+    def offsets(self, pos):
+        delta = np.asarray(pos, dtype=np.float64) - self.center
+        if self.boxSize is not None:
+            delta = delta - self.boxSize*np.round(delta/self.boxSize)
+        return delta
+
+    #returns boolean mask of the positions (n,3) inside the region
+    #axes are tested one after the other on the rows still inside, so a small region costs about one pass over one column
+    def mask(self, pos):
+        pos = np.asarray(pos)
+        extent = self.radius if self.radius is not None else self.halfWidth
+        rows = np.arange(len(pos))
+        for axis in range(3):
+            column = pos[:, axis] if axis == 0 else pos[rows, axis]
+            delta = column.astype(np.float64) - self.center[axis]
+            if self.boxSize is not None:
+                delta = delta - self.boxSize*np.round(delta/self.boxSize)
+            rows = rows[np.abs(delta) < extent]
+        if self.radius is not None:
+            delta = self.offsets(pos[rows])
+            rows = rows[np.sum(delta*delta, axis=1) < self.radius*self.radius]
+        inside = np.zeros(len(pos), dtype=bool)
+        inside[rows] = True
+        return inside
+
+    #returns True if the axis aligned bounding box lo..hi can contain positions of the region
+    def intersects(self, lo, hi):
+        lo = np.asarray(lo, dtype=np.float64)
+        hi = np.asarray(hi, dtype=np.float64)
+        delta = np.abs(self.offsets((lo+hi)/2.))
+        gap = np.maximum(delta - (hi-lo)/2., 0.)
+        if self.radius is not None:
+            return np.sum(gap*gap) <= self.radius*self.radius
+        return bool(np.all(gap <= self.halfWidth))
+
+    #returns (n,3) integer coordinates of the cells of a 2**bits grid over boxSize that can contain positions of the region
+    def cells(self, bits, boxSize):
+        n = 1 << int(bits)
+        extent = self.radius if self.radius is not None else self.halfWidth
+        axes = []
+        for axis in range(3):
+            lo = int(np.floor((self.center[axis] - extent)/boxSize*n))
+            hi = int(np.floor((self.center[axis] + extent)/boxSize*n))
+            if hi - lo + 1 >= n:
+                axes.append(np.arange(n))
+            elif self.boxSize is not None:
+                axes.append(np.unique(np.mod(np.arange(lo, hi+1), n)))
+            else:
+                axes.append(np.arange(max(lo, 0), min(hi, n-1)+1))
+        return np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+#spreads the lowest 21 bits of x so that two zero bits follow each
+def spread_bits(x):
+    x = x & np.uint64(0x1fffff)
+    x = (x | x << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    x = (x | x << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    x = (x | x << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    x = (x | x << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    x = (x | x << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return x
+
+
+#returns uint64 Morton (Z-order) keys of integer cell coordinates (n,3), at most 21 bits per axis
+def get_morton_keys(cells):
+    cells = np.asarray(cells).astype(np.uint64).reshape(-1, 3)
+    return spread_bits(cells[:, 0]) | spread_bits(cells[:, 1]) << np.uint64(1) | spread_bits(cells[:, 2]) << np.uint64(2)
+
+
+#returns integer cell coordinates of the positions (n,3) on a 2**bits grid over the periodic box
+def get_cells(pos, boxSize, bits):
+    n = 1 << int(bits)
+    cells = np.floor(np.mod(np.asarray(pos, dtype=np.float64), boxSize)/boxSize*n).astype(np.int64)
+    return np.clip(cells, 0, n-1)
+
+
+
+
+#on-disk cache of reader output, one directory of .npy columns per entry
+#entries are keyed by the source files (path, mtime, size), the part of the snapshot and the block names,
+#so a changed snapshot gets a new key and the stale entry is evicted once the cache is over maxBytes (least recently used first)
+class snapshot_cache():
+    def __init__(self, cacheDir, maxBytes=10*1024**3):
+        if cacheDir[-1] != "/":
+            cacheDir = cacheDir + "/"
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        os.makedirs(cacheDir, exist_ok=True)
+
+    #returns hex key of a snapshot part ("PartType0", "Group", ...) read from fileList
+    #stamps are the [mtime_ns, size] of the files if known already (from a snapshot_catalogue)
+    def get_key(self, fileList, part, blockNames, stamps=None):
+        if stamps is None:
+            stamps = [get_file_stamp(None, filename) for filename in fileList]
+        files = []
+        for filename, stamp in zip(fileList, stamps):
+            files.append([os.path.abspath(filename)] + list(stamp))
+        description = json.dumps([files, part, sorted(blockNames)])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    #returns (df, meta) of a cached entry (columns memory-mapped while building the df) or None
+    def load(self, key):
+        entryPath = self.cacheDir + key + "/"
+        try:
+            with open(entryPath + "meta.json") as fp:
+                meta = json.load(fp)
+            dfStructure = {}
+            for column in meta["columns"]:
+                dfStructure[column] = np.load(entryPath + column + ".npy", mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        os.utime(entryPath + "meta.json")
+        dfEntry = pd.DataFrame(dfStructure, columns=meta["columns"])
+        return dfEntry, meta
+
+    #writes df as a new entry (into a temporary dir first, so readers never see half an entry)
+    def store(self, key, df, **meta):
+        entryPath = self.cacheDir + key + "/"
+        tmpPath = self.cacheDir + ".tmp-{}-{}/".format(key, os.getpid())
+        os.makedirs(tmpPath, exist_ok=True)
+        numBytes = 0
+        for column in df.columns:
+            values = np.ascontiguousarray(df[column].values)
+            np.save(tmpPath + column + ".npy", values)
+            numBytes += values.nbytes
+        meta["columns"] = list(df.columns)
+        meta["bytes"] = numBytes
+        with open(tmpPath + "meta.json", "w") as fp:
+            json.dump(meta, fp)
+        try:
+            os.rename(tmpPath, entryPath)
+        except OSError:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+        self.evict()
+
+    #deletes least recently used entries until the cache fits into maxBytes
+    def evict(self):
+        entries = []
+        totalBytes = 0
+        for key in os.listdir(self.cacheDir):
+            metaPath = self.cacheDir + key + "/meta.json"
+            try:
+                with open(metaPath) as fp:
+                    numBytes = json.load(fp)["bytes"]
+                lastUsed = os.stat(metaPath).st_mtime
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((lastUsed, numBytes, key))
+            totalBytes += numBytes
+        for lastUsed, numBytes, key in sorted(entries):
+            if totalBytes <= self.maxBytes:
+                break
+            shutil.rmtree(self.cacheDir + key, ignore_errors=True)
+            totalBytes -= numBytes
+
+    #returns the stored per-type bounds entry of a snapshot file or None
+    def load_bounds(self, filename):
+        boundsPath = self.get_bounds_path(filename)
+        try:
+            with open(boundsPath) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    #stores the per-type bounds entry of a snapshot file
+    def store_bounds(self, filename, entry):
+        boundsPath = self.get_bounds_path(filename)
+        os.makedirs(os.path.dirname(boundsPath), exist_ok=True)
+        with open(boundsPath + ".tmp", "w") as fp:
+            json.dump(entry, fp)
+        os.replace(boundsPath + ".tmp", boundsPath)
+
+    #bounds live next to the entries, one small json per snapshot file
+    def get_bounds_path(self, filename):
+        name = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()
+        return self.cacheDir + "bounds/" + name + ".json"
+
+    #deletes every entry
+    def clear(self):
+        for key in os.listdir(self.cacheDir):
+            shutil.rmtree(self.cacheDir + key, ignore_errors=True)
+
+
+
+
+#per-snapshot kd-trees over particle positions, query results are row positions (iloc) into the df
+#with boxSize set, queries wrap around the periodic box edges
+class spatial_index():
+    def __init__(self, particles, boxSize=None, leafsize=16):
+        self.boxSize = boxSize
+        self.numRows = len(particles)
+        #the index answers only for the frame holding these very arrays
+        self.arrays = get_column_arrays(particles, ["posX", "posY", "posZ", "Snap"])
+        pos = np.column_stack((particles["posX"].values, particles["posY"].values, particles["posZ"].values)).astype(np.float64)
+        if boxSize is not None:
+            pos = self.wrap(pos)
+        snaps = np.asarray(particles["Snap"].values)
+        order = np.argsort(snaps, kind="stable")
+        snapList, starts = np.unique(snaps[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.rows = {}
+        self.trees = {}
+        for snap, start, end in zip(snapList, starts, ends):
+            rows = order[start:end]
+            self.rows[int(snap)] = rows
+            self.trees[int(snap)] = scipy.spatial.cKDTree(pos[rows], leafsize=leafsize, boxsize=boxSize)
+
+    #the index is shared, not copied, when pandas copies df.attrs
+    def __deepcopy__(self, memo):
+        return self
+
+    #maps positions into [0, boxSize)
+    def wrap(self, pos):
+        pos = np.mod(pos, self.boxSize)
+        pos[pos >= self.boxSize] = 0.
+        return pos
+
+    #returns minimum-image offsets pos-center
+    def offsets(self, pos, center):
+        delta = np.asarray(pos, dtype=np.float64) - np.asarray(center, dtype=np.float64)
+        if self.boxSize is not None:
+            delta = delta - self.boxSize*np.round(delta/self.boxSize)
+        return delta
+
+    #returns sorted row positions of the query hits in one snapshot
+    def get_rows(self, snap, hits):
+        return np.sort(self.rows[int(snap)][np.asarray(hits, dtype=np.int64)])
+
+    #rows with |pos-center| < halfWidth on every axis (open box, like the masks in norm_select/map)
+    def query_box(self, snap, center, halfWidth):
+        tree = self.trees[int(snap)]
+        center = np.asarray(center, dtype=np.float64)
+        if self.boxSize is not None:
+            center = self.wrap(center)
+        hits = np.asarray(tree.query_ball_point(center, halfWidth, p=np.inf), dtype=np.int64)
+        delta = self.offsets(tree.data[hits], center)
+        hits = hits[np.all(np.abs(delta) < halfWidth, axis=1)]
+        return self.get_rows(snap, hits)
+
+    #rows with |pos-center| < radius
+    def query_sphere(self, snap, center, radius):
+        tree = self.trees[int(snap)]
+        center = np.asarray(center, dtype=np.float64)
+        if self.boxSize is not None:
+            center = self.wrap(center)
+        hits = np.asarray(tree.query_ball_point(center, radius), dtype=np.int64)
+        delta = self.offsets(tree.data[hits], center)
+        hits = hits[np.sum(delta*delta, axis=1) < radius*radius]
+        return self.get_rows(snap, hits)
+
+    #rows and distances of the k nearest particles, nearest first
+    def query_knn(self, snap, center, k=1):
+        tree = self.trees[int(snap)]
+        center = np.asarray(center, dtype=np.float64)
+        if self.boxSize is not None:
+            center = self.wrap(center)
+        k = min(k, tree.n)
+        dist, hits = tree.query(center, k=k)
+        hits = np.atleast_1d(hits)
+        return self.rows[int(snap)][hits], np.atleast_1d(dist)
+
+
+#builds a spatial_index and attaches it to particles.attrs so norm_select and map pick it up
+def build_spatial_index(particles, boxSize=None, leafsize=16):
+    index = spatial_index(particles, boxSize=boxSize, leafsize=leafsize)
+    particles.attrs["spatialIndex"] = index
+    return index
+
+
+#returns the spatial_index attached to particles, None if missing or built for a different df
+#pandas copies attrs into derived frames, so a sorted or edited copy falls back to the masks
+def get_spatial_index(particles):
+    index = getattr(particles, "attrs", {}).get("spatialIndex")
+    if index is None or index.numRows != len(particles) or not same_column_arrays(particles, ["posX", "posY", "posZ", "Snap"], index.arrays):
+        return None
+    return index
+
+
+#returns the arrays of columns of particles (the index under "index"), kept to tie a derived structure to this df
+def get_column_arrays(particles, columns):
+    return [np.asarray(particles.index.values if column == "index" else particles[column].values) for column in columns]
+
+
+#returns True if the columns of particles are still the very arrays get_column_arrays returned
+def same_column_arrays(particles, columns, arrays):
+    for column, array in zip(columns, arrays):
+        if column != "index" and column not in particles.columns:
+            return False
+        current = get_column_arrays(particles, [column])[0]
+        if current.shape != array.shape or current.strides != array.strides or \
+           current.__array_interface__["data"][0] != array.__array_interface__["data"][0]:
+            return False
+    return True
+
+
+#returns the particles of one snapshot inside the box around center, positions unwrapped around center
+def select_box(particles, snap, center, halfWidth):
+    if is_lazy(particles):
+        galPosX, galPosY, galPosZ = center
+        sel = (particles.Snap == snap)&\
+              (particles.posX<(galPosX+halfWidth))&(particles.posX>(galPosX-halfWidth))&\
+              (particles.posY<(galPosY+halfWidth))&(particles.posY>(galPosY-halfWidth))&\
+              (particles.posZ<(galPosZ+halfWidth))&(particles.posZ>(galPosZ-halfWidth))
+        return particles[sel].compute()
+    index = get_spatial_index(particles)
+    if index is not None:
+        selected = particles.iloc[index.query_box(snap, center, halfWidth)]
+        if index.boxSize is not None:
+            selected = selected.copy(deep=True)
+            pos = selected[["posX", "posY", "posZ"]].values
+            pos = np.asarray(center) + index.offsets(pos, center)
+            selected["posX"] = np.float32(pos[:,0])
+            selected["posY"] = np.float32(pos[:,1])
+            selected["posZ"] = np.float32(pos[:,2])
+        return selected
+    galPosX, galPosY, galPosZ = center
+    sel = (particles.Snap == snap)&\
+          (particles.posX<(galPosX+halfWidth))&(particles.posX>(galPosX-halfWidth))&\
+          (particles.posY<(galPosY+halfWidth))&(particles.posY>(galPosY-halfWidth))&\
+          (particles.posZ<(galPosZ+halfWidth))&(particles.posZ>(galPosZ-halfWidth))
+    return particles[sel]
+
+
+
+
+#dense per-particle trajectories: sorted unique IDs x sorted snapshots x 3, built once from the read_arepo_raw df
+#mask[i,j] is False where particle ids[i] does not exist in snapshots[j] (positions/velocities are NaN there)
+class trajectory_store():
+    def __init__(self, particles, ids=None):
+        idValues = np.asarray(particles.index.values)
+        snaps = np.asarray(particles["Snap"].values)
+        keep = slice(None)
+        if ids is not None:
+            keep = np.isin(idValues, np.asarray(ids))
+            idValues = idValues[keep]
+            snaps = snaps[keep]
+        self.numRows = len(particles)
+        self.columns = ["index", "Snap", "posX", "posY", "posZ"] + (["velX", "velY", "velZ"] if "velX" in particles.columns else [])
+        self.arrays = get_column_arrays(particles, self.columns)
+        self.ids = np.unique(idValues)
+        self.snapshots = np.unique(snaps)
+        i = np.searchsorted(self.ids, idValues)
+        j = np.searchsorted(self.snapshots, snaps)
+        self.mask = np.zeros((len(self.ids), len(self.snapshots)), dtype=bool)
+        self.mask[i, j] = True
+        self.pos = self.fill(particles, keep, i, j, ["posX", "posY", "posZ"])
+        self.vel = None
+        if "velX" in particles.columns:
+            self.vel = self.fill(particles, keep, i, j, ["velX", "velY", "velZ"])
+
+    #the store is shared, not copied, when pandas copies df.attrs
+    def __deepcopy__(self, memo):
+        return self
+
+    #returns (n_particles, n_snapshots, 3) float32 array of three columns, NaN where missing
+    def fill(self, particles, keep, i, j, columns):
+        values = np.full((len(self.ids), len(self.snapshots), 3), np.nan, dtype=np.float32)
+        for axis, column in enumerate(columns):
+            values[i, j, axis] = np.asarray(particles[column].values)[keep]
+        return values
+
+    #returns (pos, vel, mask) of the given IDs in one gather, vel is None without velocities
+    #IDs not in the store come back fully masked
+    def gather(self, ids):
+        ids = np.asarray(ids)
+        rows = np.searchsorted(self.ids, ids)
+        rows = np.minimum(rows, max(len(self.ids)-1, 0))
+        found = (self.ids[rows] == ids) if len(self.ids) > 0 else np.zeros(len(ids), dtype=bool)
+        mask = self.mask[rows] & found[:,None]
+        pos = np.where(mask[:,:,None], self.pos[rows], np.float32(np.nan))
+        vel = None
+        if self.vel is not None:
+            vel = np.where(mask[:,:,None], self.vel[rows], np.float32(np.nan))
+        return pos, vel, mask
+
+
+#builds a trajectory_store and attaches it to particles.attrs so orbit picks it up
+def build_trajectory_store(particles, ids=None):
+    store = trajectory_store(particles, ids=ids)
+    particles.attrs["trajectoryStore"] = store
+    return store
+
+
+#returns the trajectory_store attached to particles, None if missing or built for a different df (see get_spatial_index)
+def get_trajectory_store(particles):
+    store = getattr(particles, "attrs", {}).get("trajectoryStore")
+    if store is None or store.numRows != len(particles) or not same_column_arrays(particles, store.columns, store.arrays):
+        return None
+    return store
 
 
 
@@ -264,6 +2145,128 @@ def trrot(x,y):
     return xt,yt,Ra
 
 
+#normalisation of many orbits at once, same maths as trrot: shift the first point to the origin
+#and rotate the last point onto the +x axis. x, y are (n_orbits, n_steps), mask marks valid steps
+#(default: finite values), masked steps come back as NaN
+def trrot_batch(x, y, mask=None):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if mask is None:
+        mask = np.isfinite(x) & np.isfinite(y)
+    rows = np.arange(x.shape[0])
+    first = np.argmax(mask, axis=1)
+    last = x.shape[1] - 1 - np.argmax(mask[:,::-1], axis=1)
+    xt = x - x[rows, first][:,None]
+    yt = y - y[rows, first][:,None]
+    Ra = np.hypot(xt, yt)
+    phie = np.arctan2(yt[rows, last], xt[rows, last])
+    cos = np.cos(phie)[:,None]
+    sin = np.sin(phie)[:,None]
+    xr = np.where(mask, xt*cos + yt*sin, np.nan)
+    yr = np.where(mask, yt*cos - xt*sin, np.nan)
+    Ra = np.where(mask, Ra, np.nan)
+    return xr, yr, Ra
+
+
+#interpolates many orbits at once, kind is "linear", "quadratic" or "cubic"
+#along="x" gives the curves orbit() always drew: y(x) sampled on n_valid*steps+1 points between min and max x
+#along="t" treats the orbit as a curve in time: x(t), y(t) with steps points per snapshot interval
+#returns (xSmooth, ySmooth) arrays, rows padded with NaN
+def smooth_batch(x, y, mask=None, kind="quadratic", steps=10, along="x"):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if mask is None:
+        mask = np.isfinite(x) & np.isfinite(y)
+    order = {"linear":1, "quadratic":2, "cubic":3}[kind]
+    if along == "t":
+        return smooth_time(x, y, mask, order, steps)
+    return smooth_x(x, y, mask, order, steps)
+
+
+#y(x) interpolation of smooth_batch, linear is one vectorised searchsorted, splines are fitted per orbit
+def smooth_x(x, y, mask, order, steps):
+    numValid = mask.sum(axis=1)
+    numOut = int(numValid.max())*steps + 1 if len(numValid) > 0 else 1
+    xs = np.where(mask, x, np.inf)
+    sortOrder = np.argsort(xs, axis=1, kind="stable")
+    xs = np.take_along_axis(xs, sortOrder, axis=1)
+    ys = np.take_along_axis(np.where(mask, y, np.nan), sortOrder, axis=1)
+    rows = np.arange(x.shape[0])
+    lo = xs[:,0]
+    hi = xs[rows, np.maximum(numValid-1, 0)]
+    fraction = np.arange(numOut)[None,:]/np.maximum(numValid*steps, 1)[:,None]
+    outside = fraction > 1.
+    xSmooth = lo[:,None] + (hi-lo)[:,None]*np.minimum(fraction, 1.)
+    ySmooth = np.full(xSmooth.shape, np.nan)
+    if order == 1:
+        span = np.where(hi > lo, hi-lo, 1.)
+        knots = np.where(np.isfinite(xs), (xs-lo[:,None])/span[:,None], 2.) + 3.*rows[:,None]
+        queries = (xSmooth-lo[:,None])/span[:,None] + 3.*rows[:,None]
+        index = np.searchsorted(knots.ravel(), queries.ravel(), side="right").reshape(queries.shape) - 1
+        index = index - rows[:,None]*x.shape[1]
+        index = np.clip(index, 0, np.maximum(numValid-2, 0)[:,None])
+        x0 = np.take_along_axis(xs, index, axis=1)
+        x1 = np.take_along_axis(xs, np.minimum(index+1, x.shape[1]-1), axis=1)
+        y0 = np.take_along_axis(ys, index, axis=1)
+        y1 = np.take_along_axis(ys, np.minimum(index+1, x.shape[1]-1), axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(x1 > x0, (xSmooth-x0)/(x1-x0), 0.)
+        ySmooth = y0 + weight*(y1-y0)
+    else:
+        for i in np.flatnonzero(numValid > order):
+            try:
+                spline = scipy.interpolate.make_interp_spline(xs[i,:numValid[i]], ys[i,:numValid[i]], k=order)
+            except ValueError:
+                continue
+            ySmooth[i] = spline(xSmooth[i])
+    xSmooth[numValid < 2] = np.nan
+    ySmooth[numValid < 2] = np.nan
+    xSmooth[outside] = np.nan
+    ySmooth[outside] = np.nan
+    return xSmooth, ySmooth
+
+
+#x(t), y(t) interpolation of smooth_batch, orbits without gaps share the knots and are fitted in one call
+def smooth_time(x, y, mask, order, steps):
+    numSteps = x.shape[1]
+    t = np.arange(numSteps, dtype=np.float64)
+    tSmooth = np.linspace(0., numSteps-1., (numSteps-1)*steps+1)
+    xSmooth = np.full((x.shape[0], len(tSmooth)), np.nan)
+    ySmooth = np.full((x.shape[0], len(tSmooth)), np.nan)
+    full = np.all(mask, axis=1)
+    if full.any() and numSteps > order:
+        spline = scipy.interpolate.make_interp_spline(t, np.stack((x[full], y[full])), k=order, axis=2)
+        curves = spline(tSmooth)
+        xSmooth[full] = curves[0]
+        ySmooth[full] = curves[1]
+    for i in np.flatnonzero(~full):
+        valid = t[mask[i]]
+        if len(valid) <= order:
+            continue
+        spline = scipy.interpolate.make_interp_spline(valid, np.stack((x[i, mask[i]], y[i, mask[i]])), k=order, axis=1)
+        inside = (tSmooth >= valid[0]) & (tSmooth <= valid[-1])
+        curves = spline(tSmooth[inside])
+        xSmooth[i, inside] = curves[0]
+        ySmooth[i, inside] = curves[1]
+    return xSmooth, ySmooth
+
+
+#draws many curves (rows of xs, ys, NaN dropped) as one LineCollection, returns the axes
+def plot_orbits(xs, ys, ax=None):
+    if ax is None:
+        ax = plt.figure().gca()
+    segments = []
+    for xRow, yRow in zip(xs, ys):
+        valid = np.isfinite(xRow) & np.isfinite(yRow)
+        segments.append(np.column_stack((xRow[valid], yRow[valid])))
+    lines = matplotlib.collections.LineCollection(segments, colors=plt.rcParams["axes.prop_cycle"].by_key()["color"])
+    ax.add_collection(lines)
+    ax.plot([0], [0])
+    ax.autoscale()
+    ax.grid(True)
+    return ax
+
+
 def norm_select(particles, groups, location, seed, radius=0.01, samples=10): #22669 for 122-127
     galSelect = groups.loc[int(location)]  #location
     galPosX = galSelect["posX"]
@@ -271,11 +2274,8 @@ def norm_select(particles, groups, location, seed, radius=0.01, samples=10): #22
     galPosZ = galSelect["posZ"]
     galRad = radius             #radius
     galSnap = galSelect["Snap"]
-    galFiltered = (particles.Snap == galSnap)&\
-                  (particles.posX<(galPosX+galRad))&(particles.posX>(galPosX-galRad))&\
-                  (particles.posY<(galPosY+galRad))&(particles.posY>(galPosY-galRad))&\
-                  (particles.posZ<(galPosZ+galRad))&(particles.posZ>(galPosZ-galRad))
-    ind = particles[galFiltered].sample(samples, random_state=seed).copy(deep=True)
+    galaxy = select_box(particles, galSnap, (galPosX, galPosY, galPosZ), galRad)
+    ind = galaxy.sample(samples, random_state=seed).copy(deep=True)
     ind.posX = (ind.posX - galPosX)
     ind.posY = (ind.posY - galPosY)
     ind.posZ = (ind.posZ - galPosZ)
@@ -289,38 +2289,337 @@ def orbit(particles, groups, samples=10, interpol="quadratic", steps=10, locatio
         location = np.random.choice(collection.index)
     ind = norm_select(particles, groups, location, seed, radius, samples)
     ivec=ind.index.drop_duplicates()
-    normList = []
-    for i in range(len(ivec)):
-        tCords = particles.loc[ivec[i]]
-        tX = np.array(tCords["posX"])
-        tY = np.array(tCords["posY"])
-        if tX.size < 5:
-            continue
-        tList = trrot(tX, tY)
-        tdf = pd.DataFrame({"posX":tList[0], "posY":tList[1], "Ra":tList[2]})
-        normList.append(tdf)
+    if is_lazy(particles):
+        particles = particles.map_partitions(apply_filters, [("ID", "in", list(ivec))]).compute()
+    store = get_trajectory_store(particles)
+    if store is None:
+        store = trajectory_store(particles, ids=ivec)
+    pos, vel, mask = store.gather(ivec)
+    keep = mask.sum(axis=1) >= 5
+    tX, tY, Ra = trrot_batch(pos[keep,:,0], pos[keep,:,1], mask[keep])
 
     if interpol == "linear":
-        line = normList[0]*0
-        ax =line.plot(x="posX",y="posY", legend=False)
-        for i in normList:
-            i.plot(x="posX",y="posY",ax=ax, legend=False, grid=True)
+        plot_orbits(tX, tY)
 
     if interpol == "cubic" or interpol == "quadratic":
-        line = normList[0]*0
-        ax =line.plot(x="posX",y="posY", legend=False)
-        for i in normList:
-            x = i["posX"]
-            y = i["posY"]
-            xSmooth = np.linspace(np.min(x), np.max(x), len(x)*steps+1)
-            fspline = scipy.interpolate.interp1d(x, y, interpol)
-            ySmooth = fspline(xSmooth)
-            ism = pd.DataFrame({"Xsmooth":xSmooth, "Ysmooth":ySmooth})
-            ism.plot(x="Xsmooth", y="Ysmooth", ax=ax, legend=False, grid=True)
-
-def map(particles, groups, snap=None, location=None, seed=None, kind="hexbin", zoom=0.01, density=False, gridsize=None, mass=50, cmap="RbBu", give_location=False):
+        xSmooth, ySmooth = smooth_batch(tX, tY, mask[keep], interpol, steps)
+        plot_orbits(xSmooth, ySmooth)
+
+
+#gravitational constant in Mpc (km/s)^2 / (1e10 Msun), the units of HESTIA positions, velocities and masses
+GRAVITY = 43.0091
+
+
+#returns (halo, rows, delta, r) of every (halo, particle) pair of one snapshot with r < rMax*Radius of the halo:
+#halo indexes the rows of halos, rows the rows of particles, delta (n,3) minimum-image offsets from the halo center.
+#uses the spatial_index of particles if there is one, all halos are queried at once
+def get_halo_members(particles, halos, snap, rMax=1., boxSize=None):
+    index = get_spatial_index(particles)
+    if index is not None and int(snap) in index.trees:
+        tree = index.trees[int(snap)]
+        snapRows = index.rows[int(snap)]
+        boxSize = index.boxSize
+    else:
+        snapRows = np.flatnonzero(particles["Snap"].values == snap)
+        pos = np.column_stack((particles["posX"].values[snapRows], particles["posY"].values[snapRows], particles["posZ"].values[snapRows])).astype(np.float64)
+        if boxSize is not None:
+            pos = np.mod(pos, boxSize)
+            pos[pos >= boxSize] = 0.
+        tree = scipy.spatial.cKDTree(pos, boxsize=boxSize)
+    centers = halos[["posX", "posY", "posZ"]].values.astype(np.float64)
+    if boxSize is not None:
+        centers = np.mod(centers, boxSize)
+    radii = rMax*halos["Radius"].values.astype(np.float64)
+    hits = tree.query_ball_point(centers, radii)
+    counts = np.array([len(h) for h in hits], dtype=np.int64)
+    halo = np.repeat(np.arange(len(halos)), counts)
+    local = np.concatenate([np.asarray(h, dtype=np.int64) for h in hits]) if len(hits) > 0 else np.zeros(0, dtype=np.int64)
+    delta = tree.data[local] - centers[halo]
+    if boxSize is not None:
+        delta -= boxSize*np.round(delta/boxSize)
+    r = np.sqrt(np.sum(delta*delta, axis=1))
+    keep = r < radii[halo]
+    return halo[keep], snapRows[local[keep]], delta[keep], r[keep]
+
+
+#returns dict of snapshot -> radial profiles of every group of groups (read_arepo_gal df) in that snapshot, one row per
+#(Halo, Bin) with nBins log bins of r/Radius from rMin to rMax: rIn, rOut, NumPart, Mass, StarMass, Dens, MassEnclosed
+#(including the particles inside rMin), Vcirc (sqrt(G M(<rOut)/rOut)) and SigmaV (1D velocity dispersion in the bin).
+#particles need a Mass column (read with "Masses" in blockNames), all halos of a snapshot are reduced with bincount
+def halo_profiles(particles, groups, nBins=20, rMin=0.01, rMax=1., boxSize=None, G=GRAVITY):
+    check_mass(particles)
+    edges = np.logspace(np.log10(rMin), np.log10(rMax), nBins+1)
+    profiles = {}
+    for snap, halos in groups.groupby("Snap"):
+        if not np.any(particles["Snap"].values == snap):
+            continue
+        halo, rows, delta, r = get_halo_members(particles, halos, snap, rMax, boxSize)
+        radius = halos["Radius"].values.astype(np.float64)
+        numHalos = len(halos)
+        binNumber = np.searchsorted(edges, r/radius[halo], side="right") - 1
+        inner = binNumber < 0
+        binNumber = np.clip(binNumber, 0, nBins-1)
+        cell = halo*nBins + binNumber
+        mass = particles["Mass"].values[rows].astype(np.float64)
+        isStar = particles["Type"].values[rows] == 4
+        size = numHalos*nBins
+        ring = ~inner
+        binMass = np.bincount(cell[ring], mass[ring], size).reshape(numHalos, nBins)
+        innerMass = np.bincount(halo[inner], mass[inner], numHalos)
+        massEnclosed = innerMass[:,None] + np.cumsum(binMass, axis=1)
+        rIn = radius[:,None]*edges[None,:-1]
+        rOut = radius[:,None]*edges[None,1:]
+        vel = np.column_stack((particles["velX"].values[rows], particles["velY"].values[rows], particles["velZ"].values[rows])).astype(np.float64)
+        profiles[int(snap)] = pd.DataFrame({
+            "Halo":np.repeat(halos.index.values, nBins), "Snap":np.full(size, int(snap)), "Bin":np.tile(np.arange(nBins), numHalos),
+            "rIn":rIn.ravel(), "rOut":rOut.ravel(),
+            "NumPart":np.bincount(cell[ring], minlength=size),
+            "Mass":binMass.ravel(), "StarMass":np.bincount(cell[ring & isStar], mass[ring & isStar], size),
+            "Dens":(binMass/(4./3.*np.pi*(rOut**3 - rIn**3))).ravel(),
+            "MassEnclosed":massEnclosed.ravel(), "Vcirc":np.sqrt(G*massEnclosed/rOut).ravel(),
+            "SigmaV":get_dispersion(cell[ring], mass[ring], vel[ring], size)})
+    return profiles
+
+
+#returns dict of snapshot -> one row per group of groups in that snapshot with the particles within Radius (R_Crit200):
+#NumPart200, Mass200, StarMass200, GasMass200, SigmaV200 (1D velocity dispersion around the mass weighted mean velocity),
+#Vmax and Rmax of the circular velocity curve of the particles (sorted by radius per halo) outside rMin*Radius
+def halo_summary(particles, groups, rMin=0.01, boxSize=None, G=GRAVITY):
+    check_mass(particles)
+    summaries = {}
+    for snap, halos in groups.groupby("Snap"):
+        if not np.any(particles["Snap"].values == snap):
+            continue
+        halo, rows, delta, r = get_halo_members(particles, halos, snap, 1., boxSize)
+        numHalos = len(halos)
+        mass = particles["Mass"].values[rows].astype(np.float64)
+        particleType = particles["Type"].values[rows]
+        vel = np.column_stack((particles["velX"].values[rows], particles["velY"].values[rows], particles["velZ"].values[rows])).astype(np.float64)
+        order = np.lexsort((r, halo))
+        haloSorted = halo[order]
+        cumMass = np.cumsum(mass[order])
+        starts = np.searchsorted(haloSorted, np.arange(numHalos))
+        before = np.concatenate(([0.], cumMass))[starts]
+        radius = halos["Radius"].values.astype(np.float64)
+        vcirc = np.sqrt(G*(cumMass - before[haloSorted])/np.maximum(r[order], 1e-12))
+        vcirc[r[order] < rMin*radius[haloSorted]] = 0.
+        vmax = np.zeros(numHalos)
+        rmax = np.zeros(numHalos)
+        if len(order) > 0:
+            top = np.lexsort((vcirc, haloSorted))
+            last = np.searchsorted(haloSorted[top], np.arange(numHalos), side="right") - 1
+            filled = np.bincount(halo, minlength=numHalos) > 0
+            vmax[filled] = vcirc[top][last[filled]]
+            rmax[filled] = r[order][top][last[filled]]
+        summaries[int(snap)] = pd.DataFrame({
+            "Halo":halos.index.values, "Snap":np.full(numHalos, int(snap)), "Radius":radius,
+            "NumPart200":np.bincount(halo, minlength=numHalos), "Mass200":np.bincount(halo, mass, numHalos),
+            "StarMass200":np.bincount(halo[particleType == 4], mass[particleType == 4], numHalos),
+            "GasMass200":np.bincount(halo[particleType == 0], mass[particleType == 0], numHalos),
+            "SigmaV200":get_dispersion(halo, mass, vel, numHalos), "Vmax":vmax, "Rmax":rmax})
+    return summaries
+
+
+#returns the mass weighted 1D velocity dispersion (sqrt of the mean of the three variances) of every cell of size cells
+def get_dispersion(cell, mass, vel, size):
+    totalMass = np.bincount(cell, mass, size)
+    weight = np.where(totalMass > 0, totalMass, 1.)
+    mean = np.column_stack([np.bincount(cell, mass*vel[:,k], size)/weight for k in range(3)])
+    deviation = vel - mean[cell]
+    variance = np.bincount(cell, mass*np.sum(deviation*deviation, axis=1), size)/weight
+    return np.sqrt(variance/3.)
+
+
+#raises KeyError if particles have no Mass column
+def check_mass(particles):
+    if "Mass" not in particles.columns:
+        raise KeyError("particles have no Mass column, read them with \"Masses\" in blockNames")
+
+
+#returns the group number of each of numRows rows of one particle type, from the group lengths and offsets of that type, -1 outside
+def get_row_halos(length, offset, numRows):
+    halo = np.full(numRows, -1, dtype=np.int64)
+    length = np.asarray(length, dtype=np.int64)
+    starts = np.repeat(np.asarray(offset, dtype=np.int64) - (np.cumsum(length) - length), length)
+    halo[np.arange(len(starts)) + starts] = np.repeat(np.arange(len(length)), length)
+    return halo
+
+
+#returns the positions in idsA and in idsB of the IDs in both, ids are sorted arrays of unique IDs
+def match_ids(idsA, idsB):
+    if len(idsA) == 0 or len(idsB) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rowsB = np.minimum(np.searchsorted(idsB, idsA), len(idsB)-1)
+    rowsA = np.flatnonzero(idsB[rowsB] == idsA)
+    return rowsA, rowsB[rowsA]
+
+
+#returns dataframe of the particles of the halos of membershipFrom found in the halos of membershipTo: HaloFrom, HaloTo, NumPart
+#memberships are (ids, halo) sorted by ID (arepo_reader.read_membership), HaloTo is -1 for particles outside every halo of the other
+#snapshot, particles outside the halos of membershipFrom are left out
+def halo_transfer(membershipFrom, membershipTo):
+    idsFrom, haloFrom = membershipFrom
+    idsTo, haloTo = membershipTo
+    inHalo = np.flatnonzero(haloFrom >= 0)
+    rowsFrom, rowsTo = match_ids(idsFrom[inHalo], idsTo)
+    haloFrom = haloFrom[inHalo[rowsFrom]]
+    haloTo = haloTo[rowsTo]
+    width = int(haloTo.max()) + 2 if len(haloTo) > 0 else 1
+    pairs, counts = np.unique(haloFrom*width + haloTo + 1, return_counts=True)
+    return pd.DataFrame({"HaloFrom":pairs//width, "HaloTo":pairs % width - 1, "NumPart":counts})
+
+
+#returns scipy.sparse matrix of NumPart of a halo_transfer dataframe, rows HaloFrom and columns HaloTo (particles leaving the halos dropped)
+def transfer_matrix(transfer, numFrom=None, numTo=None):
+    inHalo = transfer[transfer["HaloTo"] >= 0]
+    numFrom = int(transfer["HaloFrom"].max()) + 1 if numFrom is None and len(transfer) > 0 else numFrom or 0
+    numTo = int(inHalo["HaloTo"].max()) + 1 if numTo is None and len(inHalo) > 0 else numTo or 0
+    return scipy.sparse.csr_matrix((inHalo["NumPart"].values, (inHalo["HaloFrom"].values, inHalo["HaloTo"].values)), shape=(numFrom, numTo))
+
+
+#returns orthonormal in-plane axes (u, v) of a projection along axis ("x", "y", "z" or a 3-vector)
+def get_projection_basis(axis="z"):
+    basis = {"x":([0., 1., 0.], [0., 0., 1.]), "y":([0., 0., 1.], [1., 0., 0.]), "z":([1., 0., 0.], [0., 1., 0.])}
+    if isinstance(axis, str):
+        u, v = basis[axis]
+        return np.array(u), np.array(v)
+    normal = np.asarray(axis, dtype=np.float64)
+    normal = normal/np.linalg.norm(normal)
+    helper = np.array([0., 0., 1.]) if abs(normal[2]) < 0.9 else np.array([1., 0., 0.])
+    u = np.cross(helper, normal)
+    u = u/np.linalg.norm(u)
+    v = np.cross(normal, u)
+    return u, v
+
+
+#returns (a, b, extent): in-plane pixel coordinates (0..gridsize) of pos (n,3) and the imshow extent of the image
+#axis-aligned projections pick the columns directly and stay in the precision of pos
+def get_plane_coordinates(pos, center, halfWidth, axis, gridsize):
+    u, v = get_projection_basis(axis)
+    center = np.asarray(center, dtype=np.float64)
+    pos = np.asarray(pos)
+    scale = gridsize/(2.*halfWidth)
+    cu = center.dot(u)
+    cv = center.dot(v)
+    if isinstance(axis, str):
+        dtype = pos.dtype.type
+        a = (pos[:, int(np.argmax(u))] - dtype(cu - halfWidth))*dtype(scale)
+        b = (pos[:, int(np.argmax(v))] - dtype(cv - halfWidth))*dtype(scale)
+    else:
+        relative = pos - center
+        a = (relative.dot(u) + halfWidth)*scale
+        b = (relative.dot(v) + halfWidth)*scale
+    extent = [cu-halfWidth, cu+halfWidth, cv-halfWidth, cv+halfWidth]
+    return a, b, extent
+
+
+#bins particles into a gridsize x gridsize image of the plane perpendicular to axis, centered on center
+#weights=None counts particles, an array sums it per pixel (e.g. masses), mean=True divides the sums by the counts
+#returns (grid, extent), grid[row of b, column of a] for imshow(origin="lower"), empty pixels of a mean are NaN
+def project(pos, center, halfWidth, axis="z", gridsize=100, weights=None, mean=False):
+    a, b, extent = get_plane_coordinates(pos, center, halfWidth, axis, gridsize)
+    inside = (a >= 0) & (a < gridsize) & (b >= 0) & (b < gridsize)
+    pixel = b[inside].astype(np.intp)*gridsize + a[inside].astype(np.intp)
+    counts = np.bincount(pixel, minlength=gridsize*gridsize).astype(np.float64)
+    if weights is None:
+        return counts.reshape(gridsize, gridsize), extent
+    sums = np.bincount(pixel, weights=np.asarray(weights, dtype=np.float64)[inside], minlength=gridsize*gridsize)
+    if mean:
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sums = np.where(counts > 0, sums/counts, np.nan)
+    return sums.reshape(gridsize, gridsize), extent
+
+
+#2D cubic spline kernel shape, support q < 1 (normalisation is done per particle)
+#written as 2(1-q)^3 - 8(1/2-q)^3 with both terms clipped at 0, which is 1 - 6q^2 + 6q^3 below q = 1/2
+def sph_kernel(q):
+    outer = np.maximum(1. - q, 0.)
+    inner = np.maximum(0.5 - q, 0.)
+    return 2.*outer*outer*outer - 8.*inner*inner*inner
+
+
+#projects gas with an SPH kernel of support hsml onto the grid, every particle's mass is spread over the pixels
+#its kernel covers (renormalised, so mass is conserved) and kernels wider than maxPixels are truncated there
+#particles are grouped by the pixel reach of their kernel, each group's (particles, stamp) weights are computed once
+#and deposited in blocks of about blockSize weights, kernels narrower than a pixel are deposited like points
+#returns (surface density grid, extent)
+def project_sph(pos, hsml, mass, center, halfWidth, axis="z", gridsize=100, maxPixels=16, blockSize=1<<22):
+    a, b, extent = get_plane_coordinates(pos, center, halfWidth, axis, gridsize)
+    pixelSize = 2.*halfWidth/gridsize
+    h = np.minimum(np.asarray(hsml, dtype=np.float64)/pixelSize, maxPixels)
+    mass = np.asarray(mass, dtype=np.float64)
+    ia = np.floor(a).astype(np.int64)
+    ib = np.floor(b).astype(np.int64)
+    reach = np.where(h < 1., 0, np.ceil(h)).astype(np.int64)
+    grid = np.zeros(gridsize*gridsize)
+    point = (reach == 0)
+    for r in np.unique(reach[~point]):
+        members = np.flatnonzero(reach == r)
+        side = np.arange(-r, r+1)
+        step = max(1, blockSize//len(side)**2)
+        for start in range(0, len(members), step):
+            rows = members[start:start+step]
+            #pixel distances and indices are separable, the stamp is their outer sum
+            pa = ia[rows, None] + side
+            pb = ib[rows, None] + side
+            qa = (pa + 0.5 - a[rows, None])/h[rows, None]
+            qb = (pb + 0.5 - b[rows, None])/h[rows, None]
+            w = sph_kernel(np.sqrt(qb[:, :, None]**2 + qa[:, None, :]**2)).reshape(len(rows), -1)
+            weightSum = w.sum(axis=1)
+            #kernels that miss every pixel center are deposited like points
+            point[rows[weightSum == 0]] = True
+            w *= (mass[rows]/np.where(weightSum > 0, weightSum, 1.))[:, None]
+            inside = ((pb >= 0) & (pb < gridsize))[:, :, None] & ((pa >= 0) & (pa < gridsize))[:, None, :]
+            inside = inside.reshape(len(rows), -1) & (w > 0)
+            pixel = (pb*gridsize)[:, :, None] + pa[:, None, :]
+            grid += np.bincount(pixel.reshape(len(rows), -1)[inside], weights=w[inside], minlength=gridsize*gridsize)
+    point &= (ia >= 0) & (ia < gridsize) & (ib >= 0) & (ib < gridsize)
+    grid += np.bincount(ib[point]*gridsize + ia[point], weights=mass[point], minlength=gridsize*gridsize)
+    return grid.reshape(gridsize, gridsize)/(pixelSize*pixelSize), extent
+
+
+#computes the image map() shows for the particles of one galaxy, returns (grid, extent)
+#kind "hexbin"/"scatter" without density: particle counts, "scatter" with density: mean density,
+#"mass": projected mass, "sph": SPH-projected gas surface density (needs Mass and Dens columns)
+def map_grid(galaxy, center, zoom, kind="hexbin", density=False, gridsize=100, axis="z"):
+    pos = np.column_stack((galaxy["posX"].values, galaxy["posY"].values, galaxy["posZ"].values))
+    if kind == "sph" or kind == "mass":
+        check_mass(galaxy)
+    if kind == "sph":
+        gas = (galaxy["Type"].values == 0)
+        gasMass = galaxy["Mass"].values[gas].astype(np.float64)
+        hsml = np.power(3.*gasMass/galaxy["Dens"].values[gas]/(4.*np.pi), 1./3.)
+        return project_sph(pos[gas], hsml, gasMass, center, zoom, axis, gridsize)
+    if kind == "mass":
+        return project(pos, center, zoom, axis, gridsize, weights=galaxy["Mass"].values)
+    if kind == "scatter" and density == True:
+        dens = galaxy["Dens"].values
+        valid = np.isfinite(dens)
+        return project(pos[valid], center, zoom, axis, gridsize, weights=dens[valid], mean=True)
+    return project(pos, center, zoom, axis, gridsize)
+
+
+#draws a map_grid image on ax (a new figure if None) the way map() styles each kind, returns the axes image
+def show_grid(grid, extent, kind="hexbin", density=False, cmap="RdBu", ax=None):
+    if ax is None:
+        ax = plt.figure().gca()
+    if kind == "hexbin":
+        image = ax.imshow(np.where(grid > 0, grid, np.nan), extent=extent, origin="lower", cmap="jet", norm=colors.LogNorm(vmin=1))
+        return image
+    colormap = plt.get_cmap(cmap if (kind != "scatter" or density == True) else "gray").copy()
+    colormap.set_bad("black")
+    norm = colors.LogNorm(vmin=1) if (kind == "scatter" and density == True) else colors.LogNorm()
+    image = ax.imshow(np.where(grid > 0, grid, np.nan), extent=extent, origin="lower", cmap=colormap, norm=norm)
+    ax.set_facecolor("black")
+    return image
+
+
+def map(particles, groups, snap=None, location=None, seed=None, kind="hexbin", zoom=0.01, density=False, gridsize=None, mass=50, cmap="RdBu", give_location=False, axis="z"):
     if snap == None:
-        snap = int(particles["Snap"].drop_duplicates().sample(1, random_state=seed).values)
+        snaps = particles["Snap"].drop_duplicates()
+        if is_lazy(particles):
+            snaps = snaps.compute()
+        snap = int(snaps.sample(1, random_state=seed).values[0])
     if location == None:
         possibles = groups[groups["Snap"] == snap]
         collection = possibles[possibles["Mass"] > mass]
@@ -331,27 +2630,203 @@ def map(particles, groups, snap=None, location=None, seed=None, kind="hexbin", z
     galPosY = groups.loc[location].posY
     galPosZ = groups.loc[location].posZ
 
-    sel = (particles.Snap == snap)&\
-          (particles.posX<(galPosX+zoom))&(particles.posX>(galPosX-zoom))&\
-          (particles.posY<(galPosY+zoom))&(particles.posY>(galPosY-zoom))&\
-          (particles.posZ<(galPosZ+zoom))&(particles.posZ>(galPosZ-zoom))
+    galaxy = select_box(particles, snap, (galPosX, galPosY, galPosZ), zoom)
 
-    if density == True:
-        galDens = particles[sel]["Dens"]
+    if gridsize == None:
+        gridsize = 100 if kind == "hexbin" else 400
+    grid, extent = map_grid(galaxy, (galPosX, galPosY, galPosZ), zoom, kind, density, gridsize, axis)
+    show_grid(grid, extent, kind, density, cmap)
 
-    if kind == "hexbin":
-        if gridsize == None:
-            gridsize = 100
-        particles[sel].plot(kind='hexbin',x="posX",y="posY", gridsize=gridsize, colormap="jet",norm=colors.LogNorm(),vmin=1)
+    if give_location == True:
+        return location
 
-    if kind == "scatter" and density == True:
-        particles[sel].plot(kind='scatter',x="posX",y="posY", c=galDens, cmap=plt.cm.get_cmap(cmap),s=0.4, marker=".", norm=colors.LogNorm(), vmin=1).set_facecolor('black')
+#returns a list of camera dicts (snapshot, center, zoom, axis), framesPerSnapshot frames per snapshot
+#center and zoom move linearly from the start values to endCenter/endZoom over the whole path
+def camera_path(snapshots, center, zoom, axis="z", framesPerSnapshot=1, endCenter=None, endZoom=None):
+    snapshotList = np.repeat(np.asarray(snapshots), framesPerSnapshot)
+    startCenter = np.asarray(center, dtype=np.float64)
+    endCenter = startCenter if endCenter is None else np.asarray(endCenter, dtype=np.float64)
+    endZoom = zoom if endZoom is None else endZoom
+    fractions = np.linspace(0., 1., len(snapshotList)) if len(snapshotList) > 1 else np.zeros(1)
+    cameras = []
+    for snapshot, fraction in zip(snapshotList, fractions):
+        cameras.append({"snapshot":int(snapshot), "center":(startCenter + fraction*(endCenter-startCenter)).tolist(),
+                        "zoom":float(zoom + fraction*(endZoom-zoom)), "axis":axis})
+    return cameras
 
-    if kind == "scatter" and density == False:
-        particles[sel].plot(kind='scatter',x="posX",y="posY", c="w",s=0.2, marker=".").set_facecolor('black')
 
-    if give_location == True:
-        return location
+#renders one frame to pngPath without pyplot state (Agg canvas), reading only the camera's box of the snapshot
+#module level so it pickles into workers
+def render_frame(reader, camera, style, pngPath):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    queryRegion = region(camera["center"], halfWidth=camera["zoom"])
+    instance = reader.get_raw_instance(reader.get_path_raw(camera["snapshot"]))
+    queryRegion.boxSize = instance.boxSize
+    instance.region = queryRegion
+    #known file bounds (kept by the reader or its cache) skip the files the camera's box misses, as in read_region_raw
+    loaded = {}
+    for filename in instance.get_snapdirList():
+        entry = reader.load_bounds(filename)
+        if entry is not None:
+            instance.fileBounds[filename] = loaded[filename] = entry
+    galaxy = instance.read_arepo_snap()
+    for filename, entry in instance.fileBounds.items():
+        if entry is not loaded.get(filename):
+            reader.store_bounds(filename, entry)
+    pos = np.asarray(camera["center"]) + queryRegion.offsets(galaxy[["posX", "posY", "posZ"]].values)
+    galaxy["posX"] = pos[:,0]
+    galaxy["posY"] = pos[:,1]
+    galaxy["posZ"] = pos[:,2]
+    grid, extent = map_grid(galaxy, camera["center"], camera["zoom"], style["kind"], style["density"], style["gridsize"], camera["axis"])
+    figure = Figure(figsize=style["figsize"], dpi=style["dpi"])
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    show_grid(grid, extent, style["kind"], style["density"], style["cmap"], ax=ax)
+    ax.set_title("snapshot {}".format(camera["snapshot"]))
+    figure.savefig(pngPath + ".tmp.png")
+    os.replace(pngPath + ".tmp.png", pngPath)
+    return pngPath
+
+
+#renders cameras (see camera_path) of reader's simulation into frames in frameDir and encodes them to outPath
+#(.gif with Pillow, anything else with ffmpeg). Frames are cached by camera, style and source files,
+#so only frames whose parameters or snapshot changed are rendered again, workers renders them in a process pool
+def render_animation(reader, cameras, outPath, frameDir=None, workers=None, kind="hexbin", density=False, gridsize=200, cmap="RdBu", figsize=(6, 6), dpi=100, fps=10):
+    if frameDir is None:
+        frameDir = os.path.splitext(outPath)[0] + "_frames"
+    os.makedirs(frameDir, exist_ok=True)
+    style = {"kind":kind, "density":density, "gridsize":gridsize, "cmap":cmap, "figsize":list(figsize), "dpi":dpi}
+    reader.update_catalogue()
+    stamps = {}
+    pngPaths = []
+    tasks = []
+    for camera in cameras:
+        snapshot = camera["snapshot"]
+        if snapshot not in stamps:
+            instance = reader.get_raw_instance(reader.get_path_raw(snapshot))
+            stamps[snapshot] = [[os.path.basename(f)] + list(instance.get_stamp(f)) for f in instance.get_snapdirList()]
+        description = json.dumps([camera, style, reader.particleTypes, reader.blockNames, stamps[snapshot]], sort_keys=True)
+        pngPath = os.path.join(frameDir, hashlib.sha1(description.encode()).hexdigest() + ".png")
+        pngPaths.append(pngPath)
+        if not os.path.exists(pngPath) and pngPath not in [task[3] for task in tasks]:
+            tasks.append((reader, camera, style, pngPath))
+    logger.info("rendering {} of {} frames...".format(len(tasks), len(cameras)))
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            render_frame(*task)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(render_frame, *zip(*tasks)))
+    encode_animation(pngPaths, outPath, fps)
+    logger.info("done!")
+    return pngPaths
+
+
+#encodes png frames to outPath, .gif with Pillow (a matplotlib dependency), other formats with ffmpeg
+def encode_animation(pngPaths, outPath, fps=10):
+    if outPath.lower().endswith(".gif"):
+        from PIL import Image
+        images = [Image.open(pngPath).convert("RGB") for pngPath in pngPaths]
+        images[0].save(outPath, save_all=True, append_images=images[1:], duration=int(1000/fps), loop=0)
+        return outPath
+    import subprocess
+    listPath = outPath + ".frames.txt"
+    with open(listPath, "w") as fp:
+        for pngPath in pngPaths:
+            fp.write("file '{}'\nduration {}\n".format(os.path.abspath(pngPath), 1./fps))
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listPath,
+                    "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", outPath], check=True)
+    os.remove(listPath)
+    return outPath
+
+
+#returns the arepo_reader of the common command line arguments
+def get_cli_reader(args, **kwargs):
+    return arepo_reader(args.path, list(args.snapshots), particleTypes=args.types, blockNames=args.blocks, workers=args.workers,
+                        cacheDir=args.cache, catalogue=args.catalogue, **kwargs)
+
+
+#command line: python aiko.py (or python -m aiko) read|cache|convert|repack|render|benchmark ...
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="aiko", description="reads, caches, converts and renders AREPO snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    readers = {}
+    for name, description in [("read", "reads particles (and groups) and writes them to --output or prints a summary"),
+                              ("cache", "reads snapshots through --cache so later reads come from the cache"),
+                              ("render", "renders an animation of a box around --center")]:
+        command = commands.add_parser(name, help=description, description=description)
+        command.add_argument("-v", "--verbose", action="store_true", help="log progress")
+        command.add_argument("path", help="simulation directory with snapdir_XXX and groups_XXX")
+        command.add_argument("--snapshots", type=int, nargs="+", default=[127], help="first [last [step]] snapshot")
+        command.add_argument("--types", nargs="+", default=["Gas", "DM", "Stars"])
+        command.add_argument("--blocks", nargs="+", default=["Coordinates", "Velocities", "Density"])
+        command.add_argument("--workers", type=int, default=None)
+        command.add_argument("--cache", default=None, help="cache directory")
+        command.add_argument("--catalogue", action="store_const", const=True, default=None, help="plan reads from the metadata catalogue")
+        readers[name] = command
+    readers["read"].add_argument("--groups", action="store_true", help="read the group catalogues instead")
+    readers["read"].add_argument("--output", default=None, help=".pkl, .parquet or .csv file")
+    readers["read"].add_argument("--stats", default=None, help="JSON file for the timing and I/O report")
+    readers["cache"].add_argument("--clear", action="store_true", help="empty the cache instead")
+    readers["render"].add_argument("--center", type=float, nargs=3, required=True)
+    readers["render"].add_argument("--zoom", type=float, default=0.05, help="half width of the box")
+    readers["render"].add_argument("--end-center", type=float, nargs=3, default=None)
+    readers["render"].add_argument("--end-zoom", type=float, default=None)
+    readers["render"].add_argument("--axis", default="z")
+    readers["render"].add_argument("--frames", type=int, default=1, help="frames per snapshot")
+    readers["render"].add_argument("--kind", default="hexbin")
+    readers["render"].add_argument("--gridsize", type=int, default=200)
+    readers["render"].add_argument("--fps", type=int, default=10)
+    readers["render"].add_argument("--output", default="animation.gif")
+    commands.add_parser("convert", help="converts hdf5 snapshot files to Gadget format-2 (hdf5_gadget.py)", add_help=False)
+    commands.add_parser("repack", help="rewrites snapshots sorted along a space-filling curve for region reads (repack.py)", add_help=False)
+    commands.add_parser("benchmark", help="benchmarks on synthetic snapshots (benchmark.py)", add_help=False)
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args, rest = parser.parse_known_args(argv)
+    if args.command == "convert":
+        import hdf5_gadget
+        return hdf5_gadget.main(rest)
+    if args.command == "repack":
+        import repack
+        return repack.main(rest)
+    if args.command == "benchmark":
+        import benchmark
+        return benchmark.main(rest)
+    parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(name)s: %(message)s")
+    if args.command == "read":
+        reader = get_cli_reader(args, stats=True)
+        df = reader.read_arepo_gal() if args.groups else reader.read_arepo_raw()
+        if args.output is None:
+            print(df.groupby(["Snap"] if args.groups else ["Snap", "Type"]).size().to_string())
+        elif args.output.endswith(".parquet"):
+            df.to_parquet(args.output)
+        elif args.output.endswith(".csv"):
+            df.to_csv(args.output)
+        else:
+            df.to_pickle(args.output)
+        if args.stats is not None:
+            reader.stats.to_json(args.stats)
+    if args.command == "cache":
+        if args.cache is None:
+            parser.error("cache needs --cache")
+        reader = get_cli_reader(args)
+        if args.clear:
+            reader.cache.clear()
+        else:
+            reader.read_arepo_raw()
+            reader.read_arepo_gal()
+    if args.command == "render":
+        reader = get_cli_reader(args)
+        cameras = camera_path(reader.snapshots, args.center, args.zoom, args.axis, args.frames, args.end_center, args.end_zoom)
+        render_animation(reader, cameras, args.output, workers=args.workers, kind=args.kind, gridsize=args.gridsize, fps=args.fps)
+    return 0
+
+
+if __name__ == "__main__":
+    main()
 
 """
 TODO:
@@ -0,0 +1,221 @@
+#benchmarks of aiko and hdf5_gadget.py on synthetic snapshots (see synthetic.py)
+#every benchmark runs in a fresh process, so the peak RSS is its own, results are JSON lines
+
+import argparse
+import concurrent.futures
+import multiprocessing
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+
+#returns the bytes of the snapshot files of snapshots under path
+def get_input_bytes(path, snapshots):
+    size = 0
+    for snapshot in snapshots:
+        snapPath = os.path.join(path, "snapdir_%03d" % snapshot)
+        size += sum(os.path.getsize(os.path.join(snapPath, f)) for f in os.listdir(snapPath))
+    return size
+
+
+def get_reader(config, **kwargs):
+    import aiko
+    return aiko.arepo_reader(config["path"], [config["snapshots"][0], config["snapshots"][-1]], **kwargs)
+
+
+#every benchmark takes the config and returns run(), which does the measured work and returns {"rows":..., "bytes":...}
+#setup done before returning run is not timed
+
+def bench_read_raw(config):
+    reader = get_reader(config)
+    def run():
+        return {"rows":len(reader.read_arepo_raw()), "bytes":get_input_bytes(config["path"], reader.snapshots)}
+    return run
+
+
+def bench_read_raw_workers(config):
+    reader = get_reader(config, workers=config["workers"])
+    def run():
+        return {"rows":len(reader.read_arepo_raw()), "bytes":get_input_bytes(config["path"], reader.snapshots)}
+    return run
+
+
+def bench_read_raw_cached(config):
+    cacheDir = tempfile.mkdtemp(dir=config["tmp"])
+    reader = get_reader(config, cacheDir=cacheDir)
+    reader.read_arepo_raw()
+    def run():
+        return {"rows":len(reader.read_arepo_raw()), "bytes":get_input_bytes(config["path"], reader.snapshots)}
+    return run
+
+
+def bench_read_raw_region(config):
+    import aiko
+    groups = get_reader(config).read_arepo_gal()
+    center = groups.loc[0, ["posX", "posY", "posZ"]].values
+    reader = get_reader(config, region=aiko.region(center, halfWidth=config["halfWidth"]))
+    def run():
+        return {"rows":len(reader.read_arepo_raw()), "bytes":get_input_bytes(config["path"], reader.snapshots)}
+    return run
+
+
+def bench_read_gal(config):
+    reader = get_reader(config)
+    def run():
+        return {"rows":len(reader.read_arepo_gal()), "bytes":0}
+    return run
+
+
+def bench_read_halo(config):
+    reader = get_reader(config)
+    def run():
+        return {"rows":len(reader.read_halo(config["snapshots"][-1], 0)), "bytes":0}
+    return run
+
+
+def bench_norm_select(config):
+    import aiko
+    reader = get_reader(config)
+    particles = reader.read_arepo_raw(index=True)
+    groups = reader.read_arepo_gal()
+    locations = groups.index[:config["selections"]]
+    def run():
+        rows = 0
+        for location in locations:
+            rows += len(aiko.norm_select(particles, groups, location, 0, config["halfWidth"], 10))
+        return {"rows":rows, "bytes":0}
+    return run
+
+
+def bench_map(config):
+    import aiko
+    import matplotlib.pyplot as plt
+    reader = get_reader(config)
+    particles = reader.read_arepo_raw(index=True)
+    groups = reader.read_arepo_gal()
+    def run():
+        aiko.map(particles, groups, snap=config["snapshots"][-1], location=0, zoom=config["halfWidth"], gridsize=config["gridsize"])
+        plt.close("all")
+        return {"rows":1, "bytes":0}
+    return run
+
+
+def bench_orbit(config):
+    import aiko
+    import matplotlib.pyplot as plt
+    reader = get_reader(config)
+    particles = reader.read_arepo_raw(index=True)
+    groups = reader.read_arepo_gal()
+    aiko.build_trajectory_store(particles)
+    location = groups[groups["Snap"] == config["snapshots"][0]].index[0]
+    def run():
+        aiko.orbit(particles, groups, samples=config["samples"], location=location, radius=config["halfWidth"], seed=0)
+        plt.close("all")
+        return {"rows":config["samples"], "bytes":0}
+    return run
+
+
+def bench_hdf5_gadget(config):
+    import hdf5_gadget
+    import h5py
+    folder = tempfile.mkdtemp(dir=config["tmp"])
+    snapPath = os.path.join(config["path"], "snapdir_%03d" % config["snapshots"][-1])
+    for f in os.listdir(snapPath):
+        shutil.copy(os.path.join(snapPath, f), folder)
+    rows = 0
+    for f in os.listdir(folder):
+        with h5py.File(os.path.join(folder, f), "r") as file:
+            rows += int(np.sum(file["Header"].attrs["NumPart_ThisFile"]))
+    def run():
+        hdf5_gadget.convert_folder(folder, jobs=config["workers"])
+        return {"rows":rows, "bytes":get_input_bytes(config["path"], config["snapshots"][-1:])}
+    return run
+
+
+benchmarks = {"read_raw":bench_read_raw, "read_raw_workers":bench_read_raw_workers, "read_raw_cached":bench_read_raw_cached,
+              "read_raw_region":bench_read_raw_region, "read_gal":bench_read_gal, "read_halo":bench_read_halo,
+              "norm_select":bench_norm_select, "map":bench_map, "orbit":bench_orbit, "hdf5_gadget":bench_hdf5_gadget}
+
+
+#runs one benchmark repeat times in this (fresh) process, returns the result record
+def run_benchmark(name, config, repeat):
+    run = benchmarks[name](config)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        counts = run()
+        times.append(time.perf_counter() - start)
+    wall = min(times)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {"name":name, "wall":wall, "wallMedian":float(np.median(times)), "repeat":repeat,
+            "peakRSS":usage.ru_maxrss*1024, "peakChildRSS":childUsage.ru_maxrss*1024,
+            "rows":counts["rows"], "bytes":counts["bytes"],
+            "rowsPerSecond":counts["rows"]/wall, "bytesPerSecond":counts["bytes"]/wall}
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+#runs names (all benchmarks by default) one fresh process each and returns the result records
+def run_benchmarks(config, names=None, repeat=3):
+    names = names or list(benchmarks)
+    context = multiprocessing.get_context("spawn")
+    results = []
+    meta = {"commit":get_commit(), "python":platform.python_version(), "cpus":os.cpu_count(), "time":time.strftime("%Y-%m-%dT%H:%M:%S")}
+    for name in names:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(run_benchmark, name, config, repeat).result()
+        result.update(meta)
+        result["config"] = {k: v for k, v in config.items() if k != "tmp"}
+        print("{:<18} {:8.3f} s  {:8.1f} MB  {:12.0f} rows/s  {:8.1f} MB/s".format(name, result["wall"], result["peakRSS"]/1024**2,
+              result["rowsPerSecond"], result["bytesPerSecond"]/1024**2))
+        results.append(result)
+    return results
+
+
+def main(argv=None):
+    import synthetic
+    parser = argparse.ArgumentParser(description="benchmarks aiko on a synthetic simulation")
+    parser.add_argument("--path", default=None, help="simulation directory, generated with synthetic.py if missing")
+    parser.add_argument("--output", default=None, help="JSON lines file the results are appended to")
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks), help="benchmarks to run (default all)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--snapshots", type=int, nargs="+", default=[122, 123, 124, 125, 126, 127])
+    parser.add_argument("--particles", type=int, default=200000, help="particles per type (Gas and DM, Stars get a fifth)")
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+    tmp = tempfile.mkdtemp(prefix="aiko_benchmark_")
+    try:
+        path = args.path or os.path.join(tmp, "simulation")
+        if not os.path.isdir(os.path.join(path, "snapdir_%03d" % args.snapshots[-1])):
+            print("generating synthetic snapshots in", path)
+            numPart = {"Gas":args.particles, "DM":args.particles, "Stars":args.particles//5}
+            synthetic.make_simulation(path, args.snapshots, numPart, args.files, numGroups=args.groups)
+        config = {"path":path, "snapshots":sorted(args.snapshots), "workers":args.workers, "tmp":tmp,
+                  "halfWidth":0.05, "gridsize":200, "samples":100, "selections":20}
+        results = run_benchmarks(config, args.only, args.repeat)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if args.output is not None:
+        with open(args.output, "a") as fp:
+            for result in results:
+                fp.write(json.dumps(result) + "\n")
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
 import h5py
 import numpy as np
-import sys
 import os
+import argparse
+import concurrent.futures
+
+
+#rows copied per read/write, bounds the memory of a conversion to one slab per block
+SLAB_ROWS = 1 << 20
 
 
 def write_head(fp, header, size):
@@ -24,25 +29,42 @@ def write_header(fl, attr):
     fl.write(np.int32(256))
 
 
-if len(sys.argv) != 2:
-    print('I require only one argument -- the folder name!')
-    print('I exit, because you providing is not fit!', str(sys.argv))
-    exit(0)
-else:
-    folder = str(sys.argv[1])+"/"
-print(folder, sys.argv[1])
-h5files = [f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f))]
-
-# loop to get all required information
-for i in h5files:
-    if i[-4:] == 'hdf5' or i[-4:] == 'HDF5':
-        f = h5py.File(folder+i, "r")
-        #        of = open(folder+i[:-4]+"G3", 'wb')
-        of = open(folder+i[:-5], 'wb')
+# copies one dataset to fp in slabs of slabRows rows, converted to dtype
+def write_slabs(fp, f, path, dtype, slabRows):
+    dataset = f[path]
+    for start in range(0, dataset.shape[0], slabRows):
+        fp.write(np.asarray(dataset[start:start+slabRows], dtype=dtype))
+
+
+# copies the block of every listed part type, PartType0-3 are always written, others only if present
+def write_types(fp, f, block, dtype, types, slabRows):
+    for partType in types:
+        group = 'PartType{}'.format(partType)
+        if group not in f.keys():
+            if partType > 3:
+                continue
+            raise KeyError("{} missing in {}".format(group, f.filename))
+        write_slabs(fp, f, '/{}/{}'.format(group, block), dtype, slabRows)
+
+
+# HSML <only gas> from volume = mass/density, written as float32 like the declared block size
+def write_hsml(fp, f, slabRows):
+    dens = f[u'PartType0/Density']
+    mass = f[u'PartType0/Masses']
+    for start in range(0, dens.shape[0], slabRows):
+        volume = np.divide(mass[start:start+slabRows], dens[start:start+slabRows])
+        hsml = np.power(3.*volume/(4.*np.pi), 1./3.)
+        fp.write(np.asarray(hsml, dtype=np.float32))
+
+
+# converts one hdf5 snapshot file to a Gadget format-2 file at outName
+def convert(inName, outName, slabRows=SLAB_ROWS):
+    with h5py.File(inName, "r") as f, open(outName, 'wb') as of:
         attrs = f['/Header'].attrs
         TNp = attrs['NumPart_ThisFile'][:6]
         TNs = np.sum(TNp)
-        print(folder+i[:-5])
+        allTypes = [0, 1, 2, 3, 4, 5]
+        print(outName)
         # HEAD
         print("writing HEAD")
         write_head(of, "HEAD", 256)
@@ -52,14 +74,7 @@ for i in h5files:
         print("writing POS")
         write_head(of, "POS ", np.uint32(TNs*4*3))
         of.write(np.uint32(TNs*4*3))
-        of.write(np.float32(f['/PartType0/Coordinates'].value))
-        of.write(np.float32(f['/PartType1/Coordinates'].value))
-        of.write(np.float32(f['/PartType2/Coordinates'].value))
-        of.write(np.float32(f['/PartType3/Coordinates'].value))
-        if 'PartType4' in f.keys():
-            of.write(np.float32(f['/PartType4/Coordinates'].value))
-        if 'PartType5' in f.keys():
-            of.write(np.float32(f['/PartType5/Coordinates'].value))
+        write_types(of, f, 'Coordinates', np.float32, allTypes, slabRows)
         of.write(np.uint32(TNs*4*3))
         print("writing MASS size:",np.uint32(TNs*4*3))
 
@@ -67,28 +82,14 @@ for i in h5files:
         print("writing VEL")
         write_head(of, "VEL ", np.uint32(TNs*4*3))
         of.write(np.uint32(TNs*4*3))
-        of.write(np.float32(f['/PartType0/Velocities'].value))
-        of.write(np.float32(f['/PartType1/Velocities'].value))
-        of.write(np.float32(f['/PartType2/Velocities'].value))
-        of.write(np.float32(f['/PartType3/Velocities'].value))
-        if 'PartType4' in f.keys():
-            of.write(np.float32(f['/PartType4/Velocities'].value))
-        if 'PartType5' in f.keys():
-            of.write(np.float32(f['/PartType5/Velocities'].value))
+        write_types(of, f, 'Velocities', np.float32, allTypes, slabRows)
         of.write(np.uint32(TNs*4*3))
 
         # ID
         print("writing ID")
         write_head(of, "ID  ", np.uint32(TNs*4))
         of.write(np.uint32(TNs*4))
-        of.write(np.uint32(f['/PartType0/ParticleIDs'].value))
-        of.write(np.uint32(f['/PartType1/ParticleIDs'].value))
-        of.write(np.uint32(f['/PartType2/ParticleIDs'].value))
-        of.write(np.uint32(f['/PartType3/ParticleIDs'].value))
-        if 'PartType4' in f.keys():
-            of.write(np.uint32(f['/PartType4/ParticleIDs'].value))
-        if 'PartType5' in f.keys():
-            of.write(np.uint32(f['/PartType5/ParticleIDs'].value))
+        write_types(of, f, 'ParticleIDs', np.uint32, allTypes, slabRows)
         of.write(np.uint32(TNs*4))
         print("writing ID size:",np.uint32(TNs*4))
 
@@ -96,16 +97,7 @@ for i in h5files:
         print("writing MASS")
         write_head(of, "MASS", np.uint32(TNs*4))
         of.write(np.uint32(TNs*4))
-        of.write(np.float32(f['/PartType0/Masses'].value))
-        of.write(np.float32(f['/PartType1/Masses'].value))
-        of.write(np.float32(f['/PartType2/Masses'].value))
-        of.write(np.float32(f['/PartType3/Masses'].value))
-        if 'PartType4' in f.keys():
-#            print("writing boundary MASS PartType4 ",len(np.float32(f['/PartType4/Masses'].value)))
-            of.write(np.float32(f['/PartType4/Masses'].value))
-        if 'PartType5' in f.keys():
-#            print("writing boundary MASS PartType5 ",len(np.float32(f['/PartType5/Masses'].value)))
-            of.write(np.float32(f['/PartType5/Masses'].value))
+        write_types(of, f, 'Masses', np.float32, allTypes, slabRows)
         of.write(np.uint32(TNs*4))
         print("writing MASS size:",np.uint32(TNs*4))
 
@@ -113,7 +105,7 @@ for i in h5files:
         print("writing U")
         write_head(of, "U   ", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(np.float32(f['/PartType0/InternalEnergy'].value))
+        write_slabs(of, f, '/PartType0/InternalEnergy', np.float32, slabRows)
         print("writing U size:",np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
 
@@ -121,35 +113,29 @@ for i in h5files:
         print("writing RHO")
         write_head(of, "RHO ", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(np.float32(f['/PartType0/Density'].value))
+        write_slabs(of, f, '/PartType0/Density', np.float32, slabRows)
         print("writing RHO size:",np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        
+
         # NE <only gas>
         print("writing NE")
         write_head(of, "NE  ", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(np.float32(f['/PartType0/ElectronAbundance'].value))
+        write_slabs(of, f, '/PartType0/ElectronAbundance', np.float32, slabRows)
         of.write(np.uint32(TNp[0]*4))
 
         # NH <only gas>
         print("writing NH")
         write_head(of, "NH  ", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(np.float32(f['/PartType0/NeutralHydrogenAbundance'].value))
+        write_slabs(of, f, '/PartType0/NeutralHydrogenAbundance', np.float32, slabRows)
         of.write(np.uint32(TNp[0]*4))
 
         # HSML <only gas>  !!Note no hsml for Arepo
         print("writing HSML")
-        #Calculate 
-        dens = np.array(f[u'PartType0/Density'])
-        mass = np.array(f[u'PartType0/Masses'])
-        volume = np.divide(mass, dens)
-        hsml  = np.power(3.*volume/(4.*np.pi), 1./3.)
-
         write_head(of, "HSML", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(hsml)
+        write_hsml(of, f, slabRows)
         #of.write(np.float32(f['/PartType0/AllowRefinement'].value))
         of.write(np.uint32(TNp[0]*4))
 
@@ -157,7 +143,7 @@ for i in h5files:
         print("writing SFR")
         write_head(of, "SFR ", np.uint32(TNp[0]*4))
         of.write(np.uint32(TNp[0]*4))
-        of.write(np.float32(f['/PartType0/StarFormationRate'].value))
+        write_slabs(of, f, '/PartType0/StarFormationRate', np.float32, slabRows)
         of.write(np.uint32(TNp[0]*4))
 
         # Z <gas + Star>
@@ -168,14 +154,41 @@ for i in h5files:
             Tbp = TNp[0]
         write_head(of, "Z   ", np.uint32(Tbp*4))
         of.write(np.uint32(Tbp*4))
-        of.write(np.float32(f['/PartType0/GFM_Metallicity'].value))
-        if 'PartType4' in f.keys():
-            of.write(np.float32(f['/PartType4/GFM_Metallicity'].value))
+        write_types(of, f, 'GFM_Metallicity', np.float32, [0, 4], slabRows)
         of.write(np.uint32(Tbp*4))
 
         if 'PartType4' in f.keys():
             # AGE <only Star> stellar formation time !!No BHs
             write_head(of, "AGE ", np.uint32(TNp[4]*4))
             of.write(np.uint32(TNp[4]*4))
-            of.write(np.float32(f['/PartType4/GFM_StellarFormationTime'].value))
+            write_slabs(of, f, '/PartType4/GFM_StellarFormationTime', np.float32, slabRows)
             of.write(np.uint32(TNp[4]*4))
+    return outName
+
+
+# converts every .hdf5 file in folder (next to the input, without the extension), jobs files at a time
+def convert_folder(folder, jobs=1, slabRows=SLAB_ROWS):
+    if folder[-1] != "/":
+        folder = folder + "/"
+    h5files = sorted(f for f in os.listdir(folder) if os.path.isfile(os.path.join(folder, f)))
+    h5files = [i for i in h5files if i[-4:] == 'hdf5' or i[-4:] == 'HDF5']
+    inNames = [folder+i for i in h5files]
+    outNames = [folder+i[:-5] for i in h5files]
+    if jobs <= 1 or len(inNames) <= 1:
+        return [convert(i, o, slabRows) for i, o in zip(inNames, outNames)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(convert, inNames, outNames, [slabRows]*len(inNames)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="converts AREPO hdf5 snapshot files to Gadget format-2")
+    parser.add_argument("folder", help="folder with the .hdf5 snapshot files")
+    parser.add_argument("--jobs", type=int, default=1, help="number of files converted in parallel")
+    parser.add_argument("--slab-rows", type=int, default=SLAB_ROWS, help="rows copied per read, bounds memory use")
+    args = parser.parse_args(argv)
+    print(args.folder)
+    convert_folder(args.folder, jobs=args.jobs, slabRows=args.slab_rows)
+
+
+if __name__ == "__main__":
+    main()
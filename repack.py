@@ -0,0 +1,142 @@
+#rewrites AREPO hdf5 snapshots with the particles of every type sorted along a Morton (Z-order) curve
+#the output files are chunked (optionally compressed) and store a cell key -> row offset table per type,
+#aiko region reads of repacked files then read only the rows of the cells around the region
+#the group catalogue offsets no longer match the particle order, aiko refuses read_halo on repacked snapshots
+
+import h5py
+import numpy as np
+import os
+import argparse
+import glob
+import shutil
+import aiko
+
+
+#bits per axis of the sort key and of the cells of the offset table (2**6 = 64 cells per axis)
+KEY_BITS = 21
+CELL_BITS = 6
+#rows per hdf5 chunk, a region read touches whole chunks
+CHUNK_ROWS = 1 << 15
+
+
+#returns the dataset at path of all files concatenated, files without it are skipped
+def read_block(fileList, path):
+    parts = []
+    for filename in fileList:
+        with h5py.File(filename, "r") as f:
+            if path in f:
+                parts.append(f[path][()])
+    return np.concatenate(parts)
+
+
+#returns sorted part type numbers with a group in any of the files, and the block names of each
+def get_type_blocks(fileList):
+    typeBlocks = {}
+    for filename in fileList:
+        with h5py.File(filename, "r") as f:
+            for group in f:
+                if group.startswith("PartType"):
+                    blocks = typeBlocks.setdefault(int(group[8:]), [])
+                    blocks += [name for name, item in f[group].items() if isinstance(item, h5py.Dataset) and name not in blocks]
+    return dict(sorted(typeBlocks.items()))
+
+
+def write_dataset(out, path, data, chunkRows, compression):
+    if len(data) == 0:
+        out.create_dataset(path, data=data)
+        return
+    chunks = (min(chunkRows, len(data)),) + data.shape[1:]
+    out.create_dataset(path, data=data, chunks=chunks, compression=compression, shuffle=compression is not None)
+
+
+#writes the offset table of one type of one output file, keys are the sorted Morton keys of its rows
+def write_index(out, partType, keys, coords, cellBits):
+    cellKeys, cellStarts = np.unique(keys >> np.uint64(3*(KEY_BITS - cellBits)), return_index=True)
+    index = out.create_group("/AikoIndex/PartType{}".format(partType))
+    index.create_dataset("CellKeys", data=cellKeys.astype(np.uint64))
+    index.create_dataset("CellOffsets", data=np.append(cellStarts, len(keys)).astype(np.int64))
+    index.attrs["Count"] = len(keys)
+    index.attrs["Lower"] = coords.min(axis=0) if len(coords) > 0 else np.zeros(3)
+    index.attrs["Upper"] = coords.max(axis=0) if len(coords) > 0 else np.zeros(3)
+
+
+#repacks the snapshot files in snapPath into numFiles files (as many as before by default) in outPath
+#memory holds the sort order of one type and one block of it at a time
+def repack_snapshot(snapPath, outPath, numFiles=None, cellBits=CELL_BITS, chunkRows=CHUNK_ROWS, compression=None):
+    fileList = sorted(glob.glob(os.path.join(snapPath, "*.hdf5")), key=aiko.get_chunk_number)
+    if not fileList:
+        raise FileNotFoundError("no hdf5 snapshot files in {}".format(snapPath))
+    numFiles = numFiles or len(fileList)
+    os.makedirs(outPath, exist_ok=True)
+    stem = os.path.basename(fileList[0]).rsplit(".", 2)[0]
+    outNames = [os.path.join(outPath, "{}.{}.hdf5".format(stem, i)) for i in range(numFiles)]
+    typeBlocks = get_type_blocks(fileList)
+    outs = [h5py.File(outName, "w") for outName in outNames]
+    try:
+        with h5py.File(fileList[0], "r") as first:
+            header = dict(first["/Header"].attrs)
+            boxSize = float(header["BoxSize"])
+            for out in outs:
+                for group in first:
+                    if group not in ("Header", "AikoIndex") and not group.startswith("PartType"):
+                        first.copy(group, out)
+        counts = np.zeros((numFiles, len(header["NumPart_ThisFile"])), dtype=np.int64)
+        for partType, blockNames in typeBlocks.items():
+            print("repacking PartType{}".format(partType))
+            coords = read_block(fileList, "/PartType{}/Coordinates".format(partType))
+            keys = aiko.get_morton_keys(aiko.get_cells(coords, boxSize, KEY_BITS))
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            coords = coords[order]
+            splits = np.linspace(0, len(order), numFiles+1).astype(np.int64)
+            for i, out in enumerate(outs):
+                counts[i, partType] = splits[i+1] - splits[i]
+                write_index(out, partType, keys[splits[i]:splits[i+1]], coords[splits[i]:splits[i+1]], cellBits)
+            del keys, coords
+            for blockName in blockNames:
+                path = "/PartType{}/{}".format(partType, blockName)
+                data = read_block(fileList, path)[order]
+                for i, out in enumerate(outs):
+                    write_dataset(out, path, data[splits[i]:splits[i+1]], chunkRows, compression)
+        for i, out in enumerate(outs):
+            attrs = out.create_group("Header").attrs
+            for name, value in header.items():
+                attrs[name] = value
+            attrs["NumPart_ThisFile"] = counts[i].astype(np.asarray(header["NumPart_ThisFile"]).dtype)
+            attrs["NumFilesPerSnapshot"] = numFiles
+            attrs["AikoRepacked"] = 1
+            out.require_group("AikoIndex").attrs["CellBits"] = cellBits
+            out.require_group("AikoIndex").attrs["KeyBits"] = KEY_BITS
+            out.require_group("AikoIndex").attrs["BoxSize"] = boxSize
+    finally:
+        for out in outs:
+            out.close()
+    return outNames
+
+
+#repacks the snapdirs of snapshots of the simulation in path into outDir, the group catalogues are copied as they are
+def repack_simulation(path, outDir, snapshots, **kwargs):
+    for snapshot in snapshots:
+        print("snapshot", snapshot)
+        repack_snapshot(os.path.join(path, "snapdir_%03d" % snapshot), os.path.join(outDir, "snapdir_%03d" % snapshot), **kwargs)
+        groupPath = os.path.join(path, "groups_%03d" % snapshot)
+        if os.path.isdir(groupPath) and not os.path.exists(os.path.join(outDir, "groups_%03d" % snapshot)):
+            shutil.copytree(groupPath, os.path.join(outDir, "groups_%03d" % snapshot))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="rewrites AREPO hdf5 snapshots sorted along a space-filling curve for fast region reads")
+    parser.add_argument("path", help="simulation directory with the snapdir_XXX folders")
+    parser.add_argument("out", help="directory the repacked snapdir_XXX (and copied groups_XXX) folders are written to")
+    parser.add_argument("--snapshots", type=int, nargs="+", required=True)
+    parser.add_argument("--files", type=int, default=None, help="files per snapshot (default as many as before)")
+    parser.add_argument("--cell-bits", type=int, default=CELL_BITS, help="bits per axis of the cells of the offset table")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows per hdf5 chunk")
+    parser.add_argument("--compression", choices=["gzip", "lzf"], default=None)
+    args = parser.parse_args(argv)
+    repack_simulation(args.path, args.out, args.snapshots, numFiles=args.files, cellBits=args.cell_bits,
+                      chunkRows=args.chunk_rows, compression=args.compression)
+
+
+if __name__ == "__main__":
+    main()
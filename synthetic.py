@@ -0,0 +1,210 @@
+#synthetic AREPO output
+#writes snapdir_XXX/snapshot_XXX.N.hdf5 and groups_XXX/fof_subhalo_tab_XXX.N.hdf5 trees
+#with the blocks aiko and hdf5_gadget.py read, so both can be measured without the HESTIA runs
+
+"""
+synthetic writes fake but realistically laid out AREPO snapshots:
+particles clustered in halos, stored ordered by group like FOF output, with group/subhalo catalogues
+"""
+
+import h5py
+import numpy as np
+import os
+import argparse
+
+
+particleTypeIndexes = {"Gas":0, "DM":1, "Darkmatter":1, "Stars":4, "BH":5}
+
+
+#returns halo catalogue (centers, velocities, masses, radii) of numGroups halos in the box
+def make_groups(numGroups, boxSize, rng):
+    mass = 10**rng.uniform(0., 4., numGroups)
+    mass = np.sort(mass)[::-1]
+    radius = 0.05*(mass/100.)**(1./3.)
+    center = rng.uniform(0., boxSize, (numGroups, 3))
+    velocity = rng.normal(0., 200., (numGroups, 3))
+    return {"center":center, "velocity":velocity, "mass":mass, "radius":radius}
+
+
+#returns particles of one type, ordered by group like FOF output: members of group 0 (innermost first), group 1, ..., then unbound
+#groupLen holds the members per group, a fraction haloFraction of all particles is bound to halos (by mass)
+def make_particles(numPart, groups, boxSize, rng, haloFraction=0.6):
+    numGroups = len(groups["mass"])
+    numBound = int(numPart*haloFraction) if numGroups > 0 else 0
+    groupLen = rng.multinomial(numBound, groups["mass"]/groups["mass"].sum()) if numGroups > 0 else np.zeros(0, dtype=np.int64)
+    member = np.repeat(np.arange(numGroups), groupLen)
+    #NFW-like concentration: radius ~ R200 * u^2 puts most members near the center
+    r = groups["radius"][member]*rng.uniform(0., 1., numBound)**2
+    direction = rng.normal(size=(numBound, 3))
+    direction /= np.linalg.norm(direction, axis=1)[:,None] + 1e-12
+    offset = direction*r[:,None]
+    order = np.lexsort((r, member))
+    offset = offset[order]
+    boundVel = groups["velocity"][member] + rng.normal(0., 100., (numBound, 3))
+    unboundPos = rng.uniform(0., boxSize, (numPart-numBound, 3))
+    unboundVel = rng.normal(0., 300., (numPart-numBound, 3))
+    return {"member":member, "offset":offset, "boundVel":boundVel, "unboundPos":unboundPos, "unboundVel":unboundVel, "groupLen":groupLen}
+
+
+#returns positions and velocities of one type at snapshot, halos and particles drift with their velocities
+def get_phase_space(particles, groups, snapshot, lastSnapshot, boxSize, drift):
+    dt = (snapshot - lastSnapshot)*drift*1e-3
+    centers = groups["center"] + groups["velocity"]*dt
+    pos = np.concatenate((centers[particles["member"]] + particles["offset"], particles["unboundPos"] + particles["unboundVel"]*dt))
+    vel = np.concatenate((particles["boundVel"], particles["unboundVel"]))
+    return np.mod(pos, boxSize), vel.astype(np.float32)
+
+
+#writes one snapshot split into numFiles chunk files
+def write_snapshot(path, snapshot, typeData, numFiles, boxSize, time):
+    snapPath = os.path.join(path, "snapdir_%03d" % snapshot)
+    os.makedirs(snapPath, exist_ok=True)
+    numTotal = np.zeros(6, dtype=np.int64)
+    for particleTypeIndex, data in typeData.items():
+        numTotal[particleTypeIndex] = len(data["ParticleIDs"])
+    splits = {t: np.array_split(np.arange(numTotal[t]), numFiles) for t in range(6)}
+    for fileNumber in range(numFiles):
+        fileName = os.path.join(snapPath, "snapshot_%03d.%d.hdf5" % (snapshot, fileNumber))
+        with h5py.File(fileName, "w") as file:
+            numThisFile = np.array([len(splits[t][fileNumber]) for t in range(6)])
+            header = file.create_group("Header")
+            header.attrs["NumPart_ThisFile"] = numThisFile.astype(np.int32)
+            header.attrs["NumPart_Total"] = numTotal.astype(np.uint32)
+            header.attrs["NumPart_Total_HighWord"] = np.zeros(6, dtype=np.uint32)
+            header.attrs["NumFilesPerSnapshot"] = np.int32(numFiles)
+            header.attrs["MassTable"] = np.zeros(6)
+            header.attrs["BoxSize"] = boxSize
+            header.attrs["Time"] = time
+            header.attrs["Redshift"] = 1./time - 1.
+            header.attrs["Omega0"] = 0.307
+            header.attrs["OmegaLambda"] = 0.693
+            header.attrs["HubbleParam"] = 0.677
+            for particleTypeIndex in range(6):
+                if particleTypeIndex not in typeData and particleTypeIndex > 3:
+                    continue
+                group = file.create_group("PartType{}".format(particleTypeIndex))
+                rows = splits[particleTypeIndex][fileNumber]
+                for blockName, values in typeData.get(particleTypeIndex, empty_blocks(particleTypeIndex)).items():
+                    group.create_dataset(blockName, data=values[rows])
+
+
+#returns the zero-length blocks of a part type that has no particles (PartType0-3 are always written)
+def empty_blocks(particleTypeIndex):
+    blocks = {"Coordinates":np.zeros((0, 3)), "Velocities":np.zeros((0, 3), dtype=np.float32),
+              "ParticleIDs":np.zeros(0, dtype=np.uint64), "Masses":np.zeros(0, dtype=np.float32)}
+    if particleTypeIndex == 0:
+        for blockName in ["Density", "InternalEnergy", "ElectronAbundance", "NeutralHydrogenAbundance", "StarFormationRate", "GFM_Metallicity"]:
+            blocks[blockName] = np.zeros(0, dtype=np.float32)
+    return blocks
+
+
+#returns the blocks of one particle type at snapshot
+def make_blocks(particleTypeIndex, particles, groups, ids, snapshot, lastSnapshot, boxSize, drift, rng):
+    pos, vel = get_phase_space(particles, groups, snapshot, lastSnapshot, boxSize, drift)
+    numPart = len(ids)
+    blocks = {"Coordinates":pos, "Velocities":vel, "ParticleIDs":ids, "Masses":np.full(numPart, 1e-4, dtype=np.float32)}
+    if particleTypeIndex == 0:
+        boundFraction = np.zeros(numPart, dtype=np.float32)
+        boundFraction[:len(particles["member"])] = 1.
+        blocks["Density"] = (1e-3*(1. + 1e3*boundFraction)*rng.lognormal(0., 1., numPart)).astype(np.float32)
+        blocks["InternalEnergy"] = rng.lognormal(5., 1., numPart).astype(np.float32)
+        blocks["ElectronAbundance"] = rng.uniform(0., 1.2, numPart).astype(np.float32)
+        blocks["NeutralHydrogenAbundance"] = rng.uniform(0., 1., numPart).astype(np.float32)
+        blocks["StarFormationRate"] = (rng.uniform(0., 1., numPart)*boundFraction).astype(np.float32)
+    if particleTypeIndex in (0, 4):
+        blocks["GFM_Metallicity"] = rng.uniform(0., 0.04, numPart).astype(np.float32)
+    if particleTypeIndex == 4:
+        blocks["GFM_StellarFormationTime"] = rng.uniform(0., 1., numPart).astype(np.float32)
+    return blocks
+
+
+#writes the group and subhalo catalogue of one snapshot split into numFiles files
+#one subhalo per group holding the inner half of the members of every type
+def write_groups(path, snapshot, groups, groupLen, numFiles, lastSnapshot, boxSize, drift):
+    groupPath = os.path.join(path, "groups_%03d" % snapshot)
+    os.makedirs(groupPath, exist_ok=True)
+    numGroups = len(groups["mass"])
+    dt = (snapshot - lastSnapshot)*drift*1e-3
+    blocks = {"Group":{}, "Subhalo":{}}
+    blocks["Group"]["GroupPos"] = np.mod(groups["center"] + groups["velocity"]*dt, boxSize)
+    blocks["Group"]["GroupCM"] = blocks["Group"]["GroupPos"]
+    blocks["Group"]["GroupVel"] = groups["velocity"].astype(np.float32)
+    blocks["Group"]["GroupMass"] = groups["mass"].astype(np.float32)
+    blocks["Group"]["Group_R_Crit200"] = groups["radius"].astype(np.float32)
+    blocks["Group"]["GroupLenType"] = groupLen.astype(np.int32)
+    blocks["Group"]["GroupLen"] = groupLen.sum(axis=1).astype(np.int32)
+    blocks["Group"]["GroupOffsetType"] = (np.cumsum(groupLen, axis=0) - groupLen).astype(np.int64)
+    blocks["Group"]["GroupFirstSub"] = np.arange(numGroups, dtype=np.int32)
+    blocks["Group"]["GroupNsubs"] = np.ones(numGroups, dtype=np.int32)
+    subLen = (groupLen + 1)//2
+    blocks["Subhalo"]["SubhaloLenType"] = subLen.astype(np.int32)
+    blocks["Subhalo"]["SubhaloLen"] = subLen.sum(axis=1).astype(np.int32)
+    blocks["Subhalo"]["SubhaloOffsetType"] = blocks["Group"]["GroupOffsetType"]
+    blocks["Subhalo"]["SubhaloGrNr"] = np.arange(numGroups, dtype=np.int32)
+    blocks["Subhalo"]["SubhaloPos"] = blocks["Group"]["GroupPos"]
+    blocks["Subhalo"]["SubhaloMass"] = (groups["mass"]/2.).astype(np.float32)
+    splits = np.array_split(np.arange(numGroups), numFiles)
+    for fileNumber in range(numFiles):
+        fileName = os.path.join(groupPath, "fof_subhalo_tab_%03d.%d.hdf5" % (snapshot, fileNumber))
+        rows = splits[fileNumber]
+        with h5py.File(fileName, "w") as file:
+            header = file.create_group("Header")
+            header.attrs["Ngroups_ThisFile"] = np.int32(len(rows))
+            header.attrs["Ngroups_Total"] = np.int32(numGroups)
+            header.attrs["Nsubgroups_ThisFile"] = np.int32(len(rows))
+            header.attrs["Nsubgroups_Total"] = np.int32(numGroups)
+            header.attrs["NumFiles"] = np.int32(numFiles)
+            header.attrs["BoxSize"] = boxSize
+            for groupName, groupBlocks in blocks.items():
+                group = file.create_group(groupName)
+                for blockName, values in groupBlocks.items():
+                    group.create_dataset(blockName, data=values[rows])
+
+
+#writes snapshots of a synthetic simulation to path
+#numPart maps particle type names (Gas, DM, Stars, BH) to particle counts, the last snapshot is the reference epoch
+def make_simulation(path, snapshots=(127,), numPart={"Gas":100000, "DM":100000, "Stars":20000}, numFiles=4, numGroupFiles=2, numGroups=100, boxSize=100., drift=1., seed=0):
+    rng = np.random.default_rng(seed)
+    groups = make_groups(numGroups, boxSize, rng)
+    snapshots = sorted(snapshots)
+    lastSnapshot = snapshots[-1]
+    typeParticles = {}
+    typeIDs = {}
+    groupLen = np.zeros((numGroups, 6), dtype=np.int64)
+    firstID = 1
+    for particleType, count in numPart.items():
+        particleTypeIndex = particleTypeIndexes[particleType]
+        typeParticles[particleTypeIndex] = make_particles(count, groups, boxSize, rng)
+        groupLen[:, particleTypeIndex] = typeParticles[particleTypeIndex]["groupLen"]
+        typeIDs[particleTypeIndex] = rng.permutation(np.arange(firstID, firstID+count, dtype=np.uint64))
+        firstID += count
+    for snapshot in snapshots:
+        time = 1./(1. + 0.05*(lastSnapshot - snapshot))
+        typeData = {}
+        for particleTypeIndex, particles in typeParticles.items():
+            typeData[particleTypeIndex] = make_blocks(particleTypeIndex, particles, groups, typeIDs[particleTypeIndex], snapshot, lastSnapshot, boxSize, drift, rng)
+        write_snapshot(path, snapshot, typeData, numFiles, boxSize, time)
+        write_groups(path, snapshot, groups, groupLen, numGroupFiles, lastSnapshot, boxSize, drift)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="writes a synthetic AREPO snapshot/group tree")
+    parser.add_argument("path", help="output directory (gets snapdir_XXX and groups_XXX)")
+    parser.add_argument("--snapshots", type=int, nargs="+", default=[122, 123, 124, 125, 126, 127])
+    parser.add_argument("--gas", type=int, default=100000)
+    parser.add_argument("--dm", type=int, default=100000)
+    parser.add_argument("--stars", type=int, default=20000)
+    parser.add_argument("--files", type=int, default=4, help="chunk files per snapshot")
+    parser.add_argument("--group-files", type=int, default=2, help="catalogue files per snapshot")
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--box", type=float, default=100.)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    numPart = {"Gas":args.gas, "DM":args.dm, "Stars":args.stars}
+    make_simulation(args.path, args.snapshots, numPart, args.files, args.group_files, args.groups, args.box, seed=args.seed)
+    print("done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+#checks that the read paths of aiko agree on a tiny synthetic simulation (see synthetic.py), run with python -m pytest
+
+import os
+import shutil
+import struct
+import h5py
+import numpy as np
+import pytest
+import aiko
+import hdf5_gadget
+import synthetic
+
+
+SNAPSHOTS = [126, 127]
+
+
+@pytest.fixture(scope="module")
+def simulation(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("simulation"))
+    synthetic.make_simulation(path, SNAPSHOTS, {"Gas":2000, "DM":2000, "Stars":400}, numFiles=3, numGroups=10)
+    return path
+
+
+@pytest.fixture(scope="module")
+def particles(simulation):
+    return aiko.arepo_reader(simulation, list(SNAPSHOTS)).read_arepo_raw()
+
+
+#returns df in (Snap, ID) order with sorted columns, so frames of different read paths compare with equals
+def normalise(df):
+    df = df.reset_index()
+    return df.sort_values(["Snap", "ID"], kind="stable").reset_index(drop=True)[sorted(df.columns)]
+
+
+def assert_same(df, expected):
+    assert normalise(df).equals(normalise(expected))
+
+
+def test_workers(simulation, particles):
+    assert_same(aiko.arepo_reader(simulation, list(SNAPSHOTS), workers=2).read_arepo_raw(), particles)
+
+
+def test_cache(simulation, particles, tmp_path):
+    reader = aiko.arepo_reader(simulation, list(SNAPSHOTS), cacheDir=str(tmp_path))
+    assert_same(reader.read_arepo_raw(), particles)
+    assert_same(reader.read_arepo_raw(), particles)
+
+
+def test_catalogue(simulation, particles, tmp_path):
+    reader = aiko.arepo_reader(simulation, list(SNAPSHOTS), catalogue=str(tmp_path / "catalogue.json"))
+    assert_same(reader.read_arepo_raw(), particles)
+    assert reader.catalogue.get_snapshots() == SNAPSHOTS
+
+
+def test_catalogue_names(simulation, tmp_path):
+    reader = aiko.arepo_reader(simulation, [127, 127], catalogue=str(tmp_path / "catalogue.json"))
+    reader.update_catalogue()
+    assert sorted(reader.catalogue.dirs) == ["groups_127", "snapdir_127"]
+    reader.build_catalogue()
+    assert reader.catalogue.get_snapshots() == SNAPSHOTS
+
+
+def test_region(simulation, particles):
+    queryRegion = aiko.region([1., 50., 99.], halfWidth=10., boxSize=100.)
+    expected = particles[queryRegion.mask(particles[["posX", "posY", "posZ"]].values)]
+    assert len(expected) > 0
+    df = aiko.arepo_reader(simulation, list(SNAPSHOTS), region=queryRegion).read_arepo_raw()
+    assert_same(df, expected)
+
+
+def test_catalogue_region(simulation, particles, tmp_path):
+    queryRegion = aiko.region([1., 50., 99.], halfWidth=10., boxSize=100.)
+    reader = aiko.arepo_reader(simulation, list(SNAPSHOTS), region=queryRegion, catalogue=str(tmp_path / "catalogue.json"))
+    reader.update_catalogue()
+    filename = os.path.join(simulation, "snapdir_127", "snapshot_127.0.hdf5")
+    with h5py.File(filename, "r") as file:
+        coords = file["/PartType1/Coordinates"][()]
+    #the catalogue scan records the bounds, so the first region query can already skip files
+    assert np.allclose(reader.load_bounds(filename)["bounds"]["1"], [coords.min(axis=0), coords.max(axis=0)])
+    assert_same(reader.read_arepo_raw(), particles[queryRegion.mask(particles[["posX", "posY", "posZ"]].values)])
+
+
+def test_repacked_region(simulation, particles, tmp_path):
+    import repack
+    repack.repack_simulation(simulation, str(tmp_path), SNAPSHOTS, numFiles=2)
+    queryRegion = aiko.region([1., 50., 99.], radius=10., boxSize=100.)
+    expected = particles[queryRegion.mask(particles[["posX", "posY", "posZ"]].values)]
+    df = aiko.arepo_reader(str(tmp_path), list(SNAPSHOTS), region=queryRegion).read_arepo_raw()
+    assert_same(df, expected)
+    with pytest.raises(ValueError):
+        aiko.arepo_reader(str(tmp_path), list(SNAPSHOTS)).read_halo(127, 0)
+
+
+def test_gadget(simulation, particles, tmp_path):
+    for snapshot in SNAPSHOTS:
+        snapPath = tmp_path / ("snapdir_%03d" % snapshot)
+        shutil.copytree(os.path.join(simulation, "snapdir_%03d" % snapshot), snapPath)
+        hdf5_gadget.convert_folder(str(snapPath))
+    df = aiko.arepo_reader(str(tmp_path), list(SNAPSHOTS), fileFormat="gadget").read_arepo_raw()
+    assert_same(df, particles)
+
+
+def test_lazy(simulation, particles):
+    pytest.importorskip("dask.dataframe")
+    reader = aiko.arepo_reader(simulation, list(SNAPSHOTS))
+    assert_same(reader.read_arepo_lazy().compute(), particles)
+    df = reader.read_arepo_lazy(filters=[("Snap", "==", 127), ("posX", "<", 50.)]).compute()
+    assert_same(df, particles[(particles["Snap"] == 127) & (particles["posX"] < 50.)])
+
+
+def test_lazy_position_pruning(simulation, particles, tmp_path):
+    pytest.importorskip("dask.dataframe")
+    import repack
+    repack.repack_simulation(simulation, str(tmp_path), SNAPSHOTS, numFiles=2)
+    reader = aiko.arepo_reader(str(tmp_path), list(SNAPSHOTS), catalogue=True)
+    reader.update_catalogue()
+    #the repacked files split the box, a cut below the lowest position of a file drops it from the partitions
+    filename = os.path.join(str(tmp_path), "snapdir_127", "snapshot_127.1.hdf5")
+    bounds = reader.load_bounds(filename)["bounds"]
+    axis = max(range(3), key=lambda axis: min(typeBounds[0][axis] for typeBounds in bounds.values() if typeBounds is not None))
+    cut = min(typeBounds[0][axis] for typeBounds in bounds.values() if typeBounds is not None)
+    column = ["posX", "posY", "posZ"][axis]
+    lazy = reader.read_arepo_lazy(filters=[(column, "<", cut)])
+    assert lazy.npartitions < 2*len(SNAPSHOTS)
+    assert_same(lazy.compute(), particles[particles[column] < np.float32(cut)])
+
+
+def test_halo(simulation, particles):
+    reader = aiko.arepo_reader(simulation, list(SNAPSHOTS))
+    ids, halo = reader.read_membership(127)
+    snap = particles[particles["Snap"] == 127]
+    for number in [0, 9]:
+        expected = snap[snap.index.isin(ids[halo == number])]
+        assert len(expected) > 0
+        assert_same(reader.read_halo(127, number), expected)
+    transfer = reader.read_transfer(126, 127)
+    assert transfer["NumPart"].sum() == np.count_nonzero(reader.read_membership(126)[1] >= 0)
+
+
+def test_stale_spatial_index(simulation):
+    particles = aiko.arepo_reader(simulation, list(SNAPSHOTS)).read_arepo_raw(index=True)
+    center = [50., 50., 50.]
+    assert aiko.get_spatial_index(particles) is not None
+    for derived in [particles.sort_values("posX"), particles.assign(posX=particles["posX"] + 10)]:
+        assert aiko.get_spatial_index(derived) is None
+        pos = derived[["posX", "posY", "posZ"]].values
+        inside = (derived["Snap"].values == 127) & np.all(np.abs(pos - center) < 5., axis=1)
+        assert_same(aiko.select_box(derived, 127, center, 5.), derived[inside])
+
+
+def test_stale_trajectory_store(simulation):
+    particles = aiko.arepo_reader(simulation, list(SNAPSHOTS)).read_arepo_raw()
+    aiko.build_trajectory_store(particles)
+    assert aiko.get_trajectory_store(particles) is not None
+    assert aiko.get_trajectory_store(particles.assign(posX=particles["posX"] + 1)) is None
+
+
+def test_stale_catalogue_cache(simulation, tmp_path):
+    path = str(tmp_path / "simulation")
+    shutil.copytree(simulation, path)
+    reader = aiko.arepo_reader(path, [127, 127], catalogue=True, cacheDir=str(tmp_path / "cache"))
+    reader.read_arepo_raw()
+    #rewritten in place, the directory mtime stays the same
+    with h5py.File(os.path.join(path, "snapdir_127", "snapshot_127.0.hdf5"), "r+") as file:
+        file["/PartType0/Coordinates"][:, 0] = 1.
+        changed = file["/PartType0/ParticleIDs"][()]
+    df = reader.read_arepo_raw()
+    assert np.all(df.loc[changed, "posX"].values == 1.)
+
+
+def test_direct_raw_count_mismatch(simulation, monkeypatch):
+    getFileCounts = aiko.snapshot_read_raw.get_file_counts
+    def get_file_counts(self, filename):
+        counts = getFileCounts(self, filename)
+        counts[0] += 1
+        return counts
+    monkeypatch.setattr(aiko.snapshot_read_raw, "get_file_counts", get_file_counts)
+    with pytest.raises(ValueError):
+        aiko.arepo_reader(simulation, [127, 127]).read_arepo_raw()
+
+
+#random orbits (n_orbits, n_steps) with a few masked steps, at least four valid ones per orbit
+def make_orbits(seed=0):
+    rng = np.random.default_rng(seed)
+    x = np.cumsum(rng.uniform(0.1, 1., (6, 9)), axis=1)
+    y = rng.normal(size=(6, 9))
+    mask = np.ones(x.shape, dtype=bool)
+    mask[1, 0] = mask[2, -1] = mask[3, 4] = mask[4, [2, 5, 6]] = False
+    return x, y, mask
+
+
+def test_trrot_batch():
+    x, y, mask = make_orbits()
+    xr, yr, Ra = aiko.trrot_batch(x, y, mask)
+    for i in range(len(x)):
+        xt, yt, R = aiko.trrot(x[i, mask[i]], y[i, mask[i]])
+        assert np.allclose(xr[i, mask[i]], xt, rtol=0., atol=1e-12)
+        assert np.allclose(yr[i, mask[i]], yt, rtol=0., atol=1e-12)
+        assert np.allclose(Ra[i, mask[i]], R, rtol=0., atol=1e-12)
+        assert np.all(np.isnan(xr[i, ~mask[i]]))
+
+
+@pytest.mark.parametrize("kind", ["linear", "quadratic", "cubic"])
+def test_smooth_batch(kind):
+    interpolate = pytest.importorskip("scipy.interpolate")
+    x, y, mask = make_orbits()
+    steps = 10
+    xs, ys = aiko.smooth_batch(x, y, mask, kind=kind, steps=steps)
+    for i in range(len(x)):
+        numValid = mask[i].sum()
+        grid = np.linspace(x[i, mask[i]].min(), x[i, mask[i]].max(), numValid*steps+1)
+        assert np.allclose(xs[i, :len(grid)], grid, rtol=0., atol=1e-12)
+        assert np.allclose(ys[i, :len(grid)], interpolate.interp1d(x[i, mask[i]], y[i, mask[i]], kind=kind)(grid), rtol=0., atol=1e-10)
+        assert np.all(np.isnan(ys[i, len(grid):]))
+    xs, ys = aiko.smooth_batch(x, y, mask, kind=kind, steps=steps, along="t")
+    tSmooth = np.linspace(0., x.shape[1]-1., (x.shape[1]-1)*steps+1)
+    for i in range(len(x)):
+        t = np.flatnonzero(mask[i]).astype(np.float64)
+        inside = (tSmooth >= t[0]) & (tSmooth <= t[-1])
+        assert np.allclose(xs[i, inside], interpolate.interp1d(t, x[i, mask[i]], kind=kind)(tSmooth[inside]), rtol=0., atol=1e-10)
+        assert np.allclose(ys[i, inside], interpolate.interp1d(t, y[i, mask[i]], kind=kind)(tSmooth[inside]), rtol=0., atol=1e-10)
+        assert np.all(np.isnan(xs[i, ~inside]))
+
+
+def test_halo_summary(simulation):
+    reader = aiko.arepo_reader(simulation, [127, 127], blockNames=["Coordinates", "Velocities", "Density", "Masses"])
+    particles = reader.read_arepo_raw()
+    groups = reader.read_arepo_gal()
+    summary = aiko.halo_summary(particles, groups, boxSize=100.)[127]
+    pos = particles[["posX", "posY", "posZ"]].values.astype(np.float64)
+    mass = particles["Mass"].values.astype(np.float64)
+    for number, halo in enumerate(groups.itertuples()):
+        delta = pos - np.array([halo.posX, halo.posY, halo.posZ], dtype=np.float64)
+        delta -= 100.*np.round(delta/100.)
+        inside = np.sum(delta*delta, axis=1) < np.float64(halo.Radius)**2
+        assert summary["NumPart200"].values[number] == inside.sum()
+        assert np.isclose(summary["Mass200"].values[number], mass[inside].sum(), rtol=1e-10)
+
+
+def test_project_sph(particles):
+    rng = np.random.default_rng(2)
+    pos = rng.uniform(0.3, 0.7, (300, 3))
+    hsml = rng.uniform(0.2, 6., 300)*0.025
+    mass = rng.uniform(1., 2., 300)
+    grid, extent = aiko.project_sph(pos, hsml, mass, [0.5, 0.5, 0.5], 0.5, gridsize=40, maxPixels=4)
+    expected = np.zeros((40, 40))
+    centers = np.arange(40) + 0.5
+    for (x, y, z), h, m in zip(pos*40, hsml*40, mass):
+        if h < 1:
+            expected[int(y), int(x)] += m
+            continue
+        w = aiko.sph_kernel(np.hypot(centers[:, None] - y, centers[None, :] - x)/min(h, 4))
+        expected += m*w/w.sum()
+    assert np.allclose(grid*0.025**2, expected, rtol=1e-10, atol=1e-12)
+    with pytest.raises(KeyError, match="Masses"):
+        aiko.map_grid(particles.drop(columns="Mass", errors="ignore"), [50., 50., 50.], 10., kind="sph")
+
+
+#returns dict of label -> payload bytes of a Gadget format-2 file, checking the framing of every block, and the label order
+def read_gadget_blocks(path):
+    with open(path, "rb") as fp:
+        data = fp.read()
+    blocks = {}
+    position = 0
+    while position < len(data):
+        head, label, size, tail = struct.unpack_from("<i4sIi", data, position)
+        length = struct.unpack_from("<I", data, position + 16)[0]
+        assert (head, tail, size) == (8, 8, length + 8)
+        blocks[label.decode()] = data[position + 20:position + 20 + length]
+        assert struct.unpack_from("<I", data, position + 20 + length)[0] == length
+        position += 24 + length
+    return blocks
+
+
+def test_convert(simulation, tmp_path):
+    inName = os.path.join(simulation, "snapdir_127", "snapshot_127.0.hdf5")
+    hdf5_gadget.convert(inName, str(tmp_path / "snapshot_127.0"))
+    blocks = read_gadget_blocks(str(tmp_path / "snapshot_127.0"))
+    assert list(blocks) == ["HEAD", "POS ", "VEL ", "ID  ", "MASS", "U   ", "RHO ", "NE  ", "NH  ", "HSML", "SFR ", "Z   ", "AGE "]
+    with h5py.File(inName, "r") as file:
+        numPart = file["/Header"].attrs["NumPart_ThisFile"]
+        types = [t for t in range(6) if "PartType{}".format(t) in file]
+        assert np.array_equal(np.frombuffer(blocks["HEAD"], dtype=np.int32, count=6), numPart[:6])
+        coords = np.concatenate([file["/PartType{}/Coordinates".format(t)][()] for t in types]).astype(np.float32)
+        assert np.array_equal(np.frombuffer(blocks["POS "], dtype=np.float32).reshape(-1, 3), coords)
+        ids = np.concatenate([file["/PartType{}/ParticleIDs".format(t)][()] for t in types]).astype(np.uint32)
+        assert np.array_equal(np.frombuffer(blocks["ID  "], dtype=np.uint32), ids)
+        volume = file["/PartType0/Masses"][()]/file["/PartType0/Density"][()]
+        hsml = np.frombuffer(blocks["HSML"], dtype=np.float32)
+        assert len(blocks["HSML"]) == 4*numPart[0]
+        assert np.allclose(hsml, (3.*volume/(4.*np.pi))**(1./3.), rtol=1e-6)
+        assert len(blocks["Z   "]) == 4*(numPart[0] + numPart[4])